@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+import time
+from collections import deque
+
+from app.config import settings
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionClass:
+    # Per-process concurrency limit with a bounded FIFO of waiters; everything beyond that is shed.
+
+    def __init__(self, name: str, pattern: str, limit: int, queue_size: int, max_wait: float):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.limit = max(1, limit)
+        self.queue_size = max(0, queue_size)
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._wait_total = 0.0
+
+    async def acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            raise Overloaded(self.name)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up; pass it on.
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            self.timed_out += 1
+            raise Overloaded(self.name) from exc
+        self._wait_total += time.monotonic() - started
+        self.admitted += 1
+
+    def release(self):
+        # Hand the slot straight to the oldest waiter so newcomers cannot jump the queue.
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "pattern": self.pattern.pattern,
+            "limit": self.limit,
+            "active": self.active,
+            "queue_size": self.queue_size,
+            "queued": len(self._waiters),
+            "max_wait_seconds": self.max_wait,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": round(self._wait_total / self.admitted * 1000, 2) if self.admitted else 0.0,
+        }
+
+
+class AdmissionController:
+    def __init__(self, exempt_pattern: str, classes: list[AdmissionClass]):
+        self.exempt = re.compile(exempt_pattern) if exempt_pattern else None
+        self.classes = classes
+
+    def classify(self, path: str) -> AdmissionClass | None:
+        if self.exempt is not None and self.exempt.search(path):
+            return None
+        for admission_class in self.classes:
+            if admission_class.pattern.search(path):
+                return admission_class
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": settings.admission_enabled,
+            "exempt_pattern": self.exempt.pattern if self.exempt is not None else None,
+            "classes": {admission_class.name: admission_class.stats() for admission_class in self.classes},
+        }
+
+
+controller = AdmissionController(
+    settings.admission_exempt_paths,
+    [
+        AdmissionClass(
+            "heavy",
+            settings.admission_heavy_paths,
+            settings.admission_heavy_limit,
+            settings.admission_heavy_queue,
+            settings.admission_heavy_max_wait_seconds,
+        ),
+        AdmissionClass(
+            "light",
+            settings.admission_light_paths,
+            settings.admission_light_limit,
+            settings.admission_light_queue,
+            settings.admission_light_max_wait_seconds,
+        ),
+    ],
+)
+
+
+class AdmissionMiddleware:
+    # Plain ASGI middleware: the slot is held until the response body is fully sent.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.admission_enabled:
+            await self.app(scope, receive, send)
+            return
+        admission_class = controller.classify(scope["path"])
+        if admission_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await admission_class.acquire()
+        except Overloaded:
+            await _reject(send, admission_class.name)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission_class.release()
+
+
+async def _reject(send, class_name: str):
+    body = json.dumps({"detail": f"Server is busy ({class_name} requests), retry later"}).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"retry-after", str(settings.admission_retry_after_seconds).encode("ascii")),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
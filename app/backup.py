@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import itertools
+import json
+import zlib
+from datetime import date, datetime
+from typing import Callable, Iterable, Iterator
+
+from sqlalchemy import Date, DateTime, insert, select, text
+from sqlalchemy.orm import Session
+
+from app.models import LibraryTrack, Playlist, PlaylistItem, User
+from app.library_sync import rebuild_sync_buckets
+from app.storage_usage import rebuild_storage_usage
+
+# Parents before children so a restore never inserts a row ahead of its foreign key.
+EXPORT_MODELS = (
+    ("user", User),
+    ("track", LibraryTrack),
+    ("playlist", Playlist),
+    ("playlist_item", PlaylistItem),
+)
+_MODELS_BY_KIND = dict(EXPORT_MODELS)
+
+
+def _encode(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialise {type(value).__name__}")
+
+
+def iter_export_lines(db: Session, batch_size: int = 1000) -> Iterator[bytes]:
+    for kind, model in EXPORT_MODELS:
+        # Server-side cursor + yield_per: only one batch of rows is held in memory at a time.
+        result = db.execute(
+            select(model.__table__).order_by(model.__table__.c.id),
+            execution_options={"stream_results": True, "yield_per": batch_size},
+        )
+        for row in result.mappings():
+            yield json.dumps({"type": kind, **row}, default=_encode, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def gzip_chunks(chunks: Iterable[bytes], flush_every: int = 256 * 1024) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    buffered = 0
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        buffered += len(chunk)
+        if buffered >= flush_every:
+            out += compressor.flush(zlib.Z_SYNC_FLUSH)
+            buffered = 0
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    chunks = iter(chunks)
+    first = next(chunks, b"")
+    decompressor = zlib.decompressobj(wbits=47) if first[:2] == b"\x1f\x8b" else None
+    pending = b""
+    for chunk in itertools.chain([first], chunks):
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        yield from lines
+    if pending:
+        yield pending
+
+
+def _decode_row(model, data: dict) -> dict:
+    row = {}
+    for column in model.__table__.columns:
+        if column.name not in data:
+            continue
+        value = data[column.name]
+        if value is not None and isinstance(column.type, DateTime):
+            value = datetime.fromisoformat(value)
+        elif value is not None and isinstance(column.type, Date):
+            value = date.fromisoformat(value)
+        row[column.name] = value
+    return row
+
+
+def parse_checkpoint(raw: str | None) -> dict[str, int]:
+    checkpoint: dict[str, int] = {}
+    for part in (raw or "").split(","):
+        kind, _, last_id = part.strip().partition(":")
+        if kind and last_id.isdigit():
+            checkpoint[kind] = int(last_id)
+    return checkpoint
+
+
+def format_checkpoint(checkpoint: dict[str, int]) -> str:
+    return ",".join(f"{kind}:{last_id}" for kind, last_id in checkpoint.items())
+
+
+def _reset_sequences(db: Session):
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    for _, model in EXPORT_MODELS:
+        table = model.__tablename__
+        db.execute(
+            text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 1)) FROM {table}")
+        )
+    db.commit()
+
+
+def restore_lines(
+    session_factory: Callable[[], Session],
+    lines: Iterable[bytes],
+    batch_size: int = 1000,
+    checkpoint: dict[str, int] | None = None,
+    on_commit: Callable[[dict[str, int]], None] | None = None,
+) -> dict:
+    # Rows at or below the checkpoint id per type were committed by an earlier run and are skipped.
+    checkpoint = dict(checkpoint or {})
+    counts: dict[str, int] = {}
+    batch: list[dict] = []
+    batch_kind: str | None = None
+    db = session_factory()
+
+    def flush():
+        nonlocal batch
+        if not batch:
+            return
+        model = _MODELS_BY_KIND[batch_kind]
+        db.execute(insert(model), batch)
+        db.commit()
+        checkpoint[batch_kind] = batch[-1]["id"]
+        counts[batch_kind] = counts.get(batch_kind, 0) + len(batch)
+        batch = []
+        if on_commit is not None:
+            on_commit(dict(checkpoint))
+
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            kind = data.pop("type", None)
+            if kind not in _MODELS_BY_KIND:
+                continue
+            if data.get("id") is not None and data["id"] <= checkpoint.get(kind, 0):
+                continue
+            if kind != batch_kind or len(batch) >= batch_size:
+                flush()
+                batch_kind = kind
+            batch.append(_decode_row(_MODELS_BY_KIND[kind], data))
+        flush()
+        _reset_sequences(db)
+        rebuild_storage_usage(db)
+        rebuild_sync_buckets(db)
+    finally:
+        db.close()
+    return {"restored": counts, "checkpoint": format_checkpoint(checkpoint)}
+
@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.config import settings
+from app.database import ShardUnavailable, shard_for_user, shard_sessions
+from app.models import LibraryChange, LibraryTrack
+from app.serialization import track_dict
+
+logger = logging.getLogger(__name__)
+
+TRACK_ADDED = "track_added"
+TRACK_UPDATED = "track_updated"
+TRACK_DELETED = "track_deleted"
+COUNTERS_CHANGED = "counters_changed"
+# Sent instead of a replay when the requested id is older than the retained log.
+RESET = "reset"
+
+_OVERFLOW = object()
+_MOVED = object()
+
+
+def record_change(db: Session, user_id: int, kind: str, track_id: int | None = None, data: dict | None = None):
+    # Added to the caller's session so the change row commits (or rolls back) with the change itself.
+    db.add(
+        LibraryChange(
+            user_id=user_id,
+            kind=kind,
+            track_id=track_id,
+            payload=json.dumps(data, separators=(",", ":")) if data is not None else None,
+        )
+    )
+
+
+def record_track_change(db: Session, row: LibraryTrack, kind: str):
+    # Flushed first so the payload carries the row's id and its new version.
+    db.flush()
+    if kind == COUNTERS_CHANGED:
+        data = {"play_count": row.play_count, "skip_count": row.skip_count, "version": row.version}
+    elif kind == TRACK_DELETED:
+        data = None
+    else:
+        data = track_dict(row)
+    record_change(db, row.user_id, kind, row.id, data)
+
+
+def change_event(row) -> dict:
+    return {
+        "id": row.id,
+        "kind": row.kind,
+        "track_id": row.track_id,
+        "data": json.loads(row.payload) if row.payload else None,
+        "ts": row.created_at.isoformat() if row.created_at else None,
+    }
+
+
+def latest_change_id(db: Session) -> int:
+    return db.query(func.coalesce(func.max(LibraryChange.id), 0)).scalar() or 0
+
+
+def visible_change_id(db: Session, after_id: int = 0) -> int:
+    # Ids are taken at insert but rows appear at commit, so on Postgres a lower id can show up after a
+    # higher one. Stop below the first gap that a recent row sits above; older gaps are rollbacks.
+    cutoff = datetime.utcnow() - timedelta(seconds=settings.change_feed_gap_grace_seconds)
+    limit = settings.change_feed_batch_size
+    recent = [
+        change_id
+        for (change_id,) in db.query(LibraryChange.id)
+        .filter(LibraryChange.id > after_id, LibraryChange.created_at >= cutoff)
+        .order_by(LibraryChange.id)
+        .limit(limit)
+    ]
+    if not recent:
+        return max(after_id, latest_change_id(db))
+    below = db.query(func.max(LibraryChange.id)).filter(LibraryChange.id < recent[0]).scalar() or 0
+    previous = max(after_id, below)
+    for change_id in recent:
+        if change_id != previous + 1:
+            return previous
+        previous = change_id
+    # Everything above the last recent row is older than the grace period, so already settled.
+    return previous if len(recent) >= limit else max(previous, latest_change_id(db))
+
+
+def is_expired(db: Session, since: int) -> bool:
+    # Ids only grow within a shard, so a gap below the oldest retained row means pruned events.
+    # A cursor above the newest id comes from another database (restore, ids restarted): start over.
+    if since <= 0:
+        return False
+    oldest, newest = db.query(func.min(LibraryChange.id), func.max(LibraryChange.id)).one()
+    return since > (newest or 0) or (oldest is not None and since + 1 < oldest)
+
+
+def changes_since(db: Session, user_id: int, since: int, until: int, limit: int) -> list[dict]:
+    rows = (
+        db.query(LibraryChange)
+        .filter(LibraryChange.user_id == user_id, LibraryChange.id > since, LibraryChange.id <= until)
+        .order_by(LibraryChange.id)
+        .limit(limit)
+        .all()
+    )
+    return [change_event(row) for row in rows]
+
+
+def prune_changes(db: Session) -> int:
+    cutoff = datetime.utcnow() - timedelta(hours=settings.change_feed_retention_hours)
+    # The newest row always stays, so max(id) never drops and ids cannot restart on tables without AUTOINCREMENT.
+    newest = latest_change_id(db)
+    deleted = (
+        db.query(LibraryChange)
+        .filter(LibraryChange.created_at < cutoff, LibraryChange.id < newest)
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return deleted
+
+
+class ChangeBroker:
+    # One poller per worker process tails each shard's library_changes table and fans rows out
+    # to that process's SSE subscribers, so a commit in any worker reaches every connection.
+
+    def __init__(self):
+        self._subscribers: dict[int, set[asyncio.Queue]] = {}
+        # Shard each subscribed user was on when their stream started; ids are per shard.
+        self._user_shards: dict[int, int] = {}
+        self._last_ids: dict[int, int] = {}
+        self._rewind: dict[int, int] = {}
+        self._wake: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+        self._last_prune: dict[int, float] = {}
+
+    def subscribe(self, user_id: int, shard: int) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=settings.change_feed_queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        self._user_shards[user_id] = shard
+        self._ensure_running()
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[user_id]
+            self._user_shards.pop(user_id, None)
+
+    def resume_from(self, shard: int, change_id: int):
+        # A subscriber has replayed up to change_id; make sure the poller does not start past it.
+        # Also recorded as a rewind, since a poll already in flight may overwrite the cursor.
+        last_id = self._last_ids.get(shard)
+        if last_id is None:
+            self._last_ids[shard] = change_id
+        if last_id is None or change_id < last_id:
+            self._rewind[shard] = min(self._rewind.get(shard, change_id), change_id)
+
+    def notify(self):
+        # Safe from threadpool routes: wakes the poller right after a local commit.
+        loop, wake = self._loop, self._wake
+        if loop is None or wake is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            pass
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._last_ids = {}
+        self._rewind = {}
+        self._wake = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    def _fetch_shard(self, shard: int, after_id: int | None, user_ids: list[int]) -> tuple[int, list]:
+        db = shard_sessions[shard]()
+        try:
+            if after_id is None:
+                return visible_change_id(db), []
+            if time.monotonic() - self._last_prune.get(shard, 0.0) > settings.change_feed_prune_interval_seconds:
+                self._last_prune[shard] = time.monotonic()
+                prune_changes(db)
+            # Read the high-water mark first so a row committed mid-poll is picked up next time.
+            latest = visible_change_id(db, after_id)
+            rows = (
+                db.query(LibraryChange)
+                .filter(
+                    LibraryChange.id > after_id,
+                    LibraryChange.id <= latest,
+                    LibraryChange.user_id.in_(user_ids),
+                )
+                .order_by(LibraryChange.id)
+                .limit(settings.change_feed_batch_size)
+                .all()
+            )
+            # Advance past other users' rows too, otherwise every poll rescans them.
+            last_id = rows[-1].id if len(rows) >= settings.change_feed_batch_size else max(latest, after_id)
+            return last_id, rows
+        finally:
+            db.close()
+
+    def _fetch(self, last_ids: dict[int, int], user_shards: dict[int, int]) -> tuple[dict[int, int], list, set[int]]:
+        by_shard: dict[int, list[int]] = {}
+        moved: set[int] = set()
+        for user_id, shard in user_shards.items():
+            try:
+                current = shard_for_user(user_id)
+            except ShardUnavailable:
+                current = None
+            if current != shard:
+                moved.add(user_id)
+            else:
+                by_shard.setdefault(shard, []).append(user_id)
+
+        last_ids = dict(last_ids)
+        rows = []
+        for shard, user_ids in by_shard.items():
+            last_ids[shard], shard_rows = self._fetch_shard(shard, last_ids.get(shard), user_ids)
+            rows.extend(shard_rows)
+        return last_ids, rows, moved
+
+    def _publish(self, user_id: int, event):
+        for queue in list(self._subscribers.get(user_id, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The subscriber catches up from the table instead of stalling the broker.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(_OVERFLOW)
+
+    async def _run(self):
+        while self._subscribers:
+            for shard, rewind in self._rewind.items():
+                last_id = self._last_ids.get(shard)
+                self._last_ids[shard] = rewind if last_id is None else min(rewind, last_id)
+            self._rewind = {}
+            try:
+                last_ids, rows, moved = await run_in_threadpool(self._fetch, self._last_ids, dict(self._user_shards))
+            except Exception:
+                logger.exception("Change feed poll failed")
+                last_ids, rows, moved = self._last_ids, [], set()
+            for user_id in moved:
+                # The stream ends; the client reconnects and replays from the library's new shard.
+                self._publish(user_id, _MOVED)
+            for row in rows:
+                self._publish(row.user_id, change_event(row))
+            self._last_ids = last_ids
+            if len(rows) >= settings.change_feed_batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=settings.change_feed_poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+
+broker = ChangeBroker()
+
+
+def _sse(event_id: int | None, kind: str, data) -> bytes:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {kind}")
+    lines.append("data: " + json.dumps(data, separators=(",", ":")))
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+def _replay(shard: int, user_id: int, since: int) -> tuple[bool, int, list[dict]]:
+    db = shard_sessions[shard]()
+    try:
+        if since < 0:
+            return False, visible_change_id(db), []
+        if is_expired(db, since):
+            return True, visible_change_id(db), []
+        until = visible_change_id(db, since)
+        return False, since, changes_since(db, user_id, since, until, settings.change_feed_batch_size)
+    finally:
+        db.close()
+
+
+async def stream_changes(user_id: int, shard: int, since: int):
+    # since < 0 means "only new events"; otherwise every event after `since` is replayed first.
+    queue = broker.subscribe(user_id, shard)
+    try:
+        yield f"retry: {settings.change_feed_retry_ms}\n\n".encode("utf-8")
+        last_sent = since
+        catch_up = True
+        while True:
+            if catch_up:
+                # Subscribed before reading, so nothing committed in between is lost; ids dedupe overlap.
+                while True:
+                    expired, cursor, events = await run_in_threadpool(_replay, shard, user_id, last_sent)
+                    if expired:
+                        yield _sse(cursor, RESET, {"id": cursor})
+                        last_sent = cursor
+                        break
+                    last_sent = max(last_sent, cursor)
+                    for event in events:
+                        yield _sse(event["id"], event["kind"], event)
+                        last_sent = event["id"]
+                    if len(events) < settings.change_feed_batch_size:
+                        break
+                broker.resume_from(shard, last_sent)
+                catch_up = False
+
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=settings.change_feed_heartbeat_seconds)
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+                continue
+            if event is _OVERFLOW:
+                catch_up = True
+                continue
+            if event is _MOVED:
+                return
+            if event["id"] <= last_sent:
+                continue
+            yield _sse(event["id"], event["kind"], event)
+            last_sent = event["id"]
+    finally:
+        broker.unsubscribe(user_id, queue)
@@ -27,6 +27,20 @@ class Settings:
     app_debug: bool = os.getenv("APP_DEBUG", "true").lower() == "true"
 
     database_url: str = os.getenv("DATABASE_URL", "sqlite:///./toporch_backend.db")
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "5"))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    db_pool_min_size: int = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+    # Comma-separated library shard URLs; empty keeps every library in DATABASE_URL.
+    database_shard_urls: tuple[str, ...] = tuple(
+        url.strip() for url in os.getenv("DATABASE_SHARD_URLS", "").split(",") if url.strip()
+    )
+    shard_directory_ttl_seconds: float = float(os.getenv("SHARD_DIRECTORY_TTL_SECONDS", "5"))
+    shard_move_retry_after_seconds: int = int(os.getenv("SHARD_MOVE_RETRY_AFTER_SECONDS", "5"))
+    shard_move_batch_size: int = int(os.getenv("SHARD_MOVE_BATCH_SIZE", "1000"))
+
+    warmup_enabled: bool = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+    readiness_timeout_seconds: float = float(os.getenv("READINESS_TIMEOUT_SECONDS", "5"))
+    warmup_shuffle_users: int = int(os.getenv("WARMUP_SHUFFLE_USERS", "100"))
 
     jwt_secret: str = os.getenv("JWT_SECRET", "change_me_super_secret")
     jwt_alg: str = os.getenv("JWT_ALG", "HS256")
@@ -46,10 +60,82 @@ class Settings:
     supabase_s3_secret_access_key: str = os.getenv("SUPABASE_S3_SECRET_ACCESS_KEY", "")
     supabase_s3_region: str = os.getenv("SUPABASE_S3_REGION", "us-east-1")
     supabase_bucket: str = os.getenv("SUPABASE_BUCKET", "music")
+    supabase_timeout_seconds: float = float(os.getenv("SUPABASE_TIMEOUT_SECONDS", "120"))
+    # 0 disables the limit.
+    storage_quota_bytes: int = int(os.getenv("STORAGE_QUOTA_BYTES", str(5 * 1024 * 1024 * 1024)))
+    max_upload_bytes: int = int(os.getenv("MAX_UPLOAD_BYTES", str(500 * 1024 * 1024)))
+    local_storage_root: str = os.getenv("LOCAL_STORAGE_ROOT", "./storage_data")
+    storage_io_workers: int = int(os.getenv("STORAGE_IO_WORKERS", "8"))
+
+    # STORAGE_PROVIDER=replicated writes to the primary and copies to the secondary in the background.
+    storage_primary: str = os.getenv("STORAGE_PRIMARY", "supabase").lower()
+    storage_secondary: str = os.getenv("STORAGE_SECONDARY", "gdrive").lower()
+    storage_replication_workers: int = int(os.getenv("STORAGE_REPLICATION_WORKERS", "2"))
+    storage_spool_max_memory: int = int(os.getenv("STORAGE_SPOOL_MAX_MEMORY", str(8 * 1024 * 1024)))
+    storage_hedge_percentile: float = float(os.getenv("STORAGE_HEDGE_PERCENTILE", "0.95"))
+    storage_hedge_default_seconds: float = float(os.getenv("STORAGE_HEDGE_DEFAULT_SECONDS", "2"))
+    storage_breaker_failures: int = int(os.getenv("STORAGE_BREAKER_FAILURES", "5"))
+    storage_breaker_reset_seconds: float = float(os.getenv("STORAGE_BREAKER_RESET_SECONDS", "30"))
 
     google_drive_enabled: bool = os.getenv("GOOGLE_DRIVE_ENABLED", "false").lower() == "true"
     google_drive_service_account_json: str = os.getenv("GOOGLE_DRIVE_SERVICE_ACCOUNT_JSON", "")
     google_drive_folder_id: str = os.getenv("GOOGLE_DRIVE_FOLDER_ID", "")
+    google_drive_batch_window_ms: float = float(os.getenv("GOOGLE_DRIVE_BATCH_WINDOW_MS", "30"))
+    google_drive_timeout_seconds: float = float(os.getenv("GOOGLE_DRIVE_TIMEOUT_SECONDS", "60"))
+
+    play_events_batch_size: int = int(os.getenv("PLAY_EVENTS_BATCH_SIZE", "500"))
+    play_events_flush_seconds: float = float(os.getenv("PLAY_EVENTS_FLUSH_SECONDS", "2"))
+    play_events_max_buffer: int = int(os.getenv("PLAY_EVENTS_MAX_BUFFER", "50000"))
+
+    shuffle_recency_half_life_hours: float = float(os.getenv("SHUFFLE_RECENCY_HALF_LIFE_HOURS", "24"))
+    shuffle_index_ttl_seconds: int = int(os.getenv("SHUFFLE_INDEX_TTL_SECONDS", "600"))
+    shuffle_index_max_users: int = int(os.getenv("SHUFFLE_INDEX_MAX_USERS", "1000"))
+
+    playlist_rank_step: float = float(os.getenv("PLAYLIST_RANK_STEP", "1024"))
+    playlist_rank_min_gap: float = float(os.getenv("PLAYLIST_RANK_MIN_GAP", "1e-6"))
+
+    backup_batch_size: int = int(os.getenv("BACKUP_BATCH_SIZE", "1000"))
+
+    cpu_pool_workers: int = int(os.getenv("CPU_POOL_WORKERS", "0"))
+
+    cover_cache_dir: str = os.getenv("COVER_CACHE_DIR", "./cover_cache")
+    cover_cache_max_bytes: int = int(os.getenv("COVER_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+    cover_sizes: frozenset[int] = _parse_int_set(os.getenv("COVER_SIZES", "64,128,256,512"))
+    cover_fetch_timeout_seconds: float = float(os.getenv("COVER_FETCH_TIMEOUT_SECONDS", "15"))
+    cover_max_source_bytes: int = int(os.getenv("COVER_MAX_SOURCE_BYTES", str(10 * 1024 * 1024)))
+    cover_cache_control: str = os.getenv("COVER_CACHE_CONTROL", "private, max-age=604800")
+
+    waveform_resolutions: frozenset[int] = _parse_int_set(os.getenv("WAVEFORM_RESOLUTIONS", "256,1024,4096"))
+    waveform_sample_rate: int = int(os.getenv("WAVEFORM_SAMPLE_RATE", "8000"))
+    waveform_decode_timeout_seconds: float = float(os.getenv("WAVEFORM_DECODE_TIMEOUT_SECONDS", "120"))
+    waveform_max_source_bytes: int = int(os.getenv("WAVEFORM_MAX_SOURCE_BYTES", str(100 * 1024 * 1024)))
+    waveform_retry_seconds: float = float(os.getenv("WAVEFORM_RETRY_SECONDS", "3600"))
+    waveform_cache_control: str = os.getenv("WAVEFORM_CACHE_CONTROL", "private, max-age=31536000, immutable")
+
+    # Per-process limits; paths are regexes matched against the request path, exempt paths are never limited.
+    admission_enabled: bool = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+    admission_exempt_paths: str = os.getenv("ADMISSION_EXEMPT_PATHS", r"^/health|/changes/stream$")
+    admission_heavy_paths: str = os.getenv(
+        "ADMISSION_HEAVY_PATHS",
+        r"^/me/library/tracks/(upload|\d+/(download|cover|waveform))$|^/admin/(export|restore)$",
+    )
+    admission_heavy_limit: int = int(os.getenv("ADMISSION_HEAVY_LIMIT", "8"))
+    admission_heavy_queue: int = int(os.getenv("ADMISSION_HEAVY_QUEUE", "16"))
+    admission_heavy_max_wait_seconds: float = float(os.getenv("ADMISSION_HEAVY_MAX_WAIT_SECONDS", "5"))
+    admission_light_paths: str = os.getenv("ADMISSION_LIGHT_PATHS", r"^/(auth|me)/")
+    admission_light_limit: int = int(os.getenv("ADMISSION_LIGHT_LIMIT", "32"))
+    admission_light_queue: int = int(os.getenv("ADMISSION_LIGHT_QUEUE", "128"))
+    admission_light_max_wait_seconds: float = float(os.getenv("ADMISSION_LIGHT_MAX_WAIT_SECONDS", "2"))
+    admission_retry_after_seconds: int = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "2"))
+
+    change_feed_poll_seconds: float = float(os.getenv("CHANGE_FEED_POLL_SECONDS", "1"))
+    change_feed_heartbeat_seconds: float = float(os.getenv("CHANGE_FEED_HEARTBEAT_SECONDS", "15"))
+    change_feed_retry_ms: int = int(os.getenv("CHANGE_FEED_RETRY_MS", "3000"))
+    change_feed_batch_size: int = int(os.getenv("CHANGE_FEED_BATCH_SIZE", "500"))
+    change_feed_queue_size: int = int(os.getenv("CHANGE_FEED_QUEUE_SIZE", "1000"))
+    change_feed_retention_hours: float = float(os.getenv("CHANGE_FEED_RETENTION_HOURS", "168"))
+    change_feed_prune_interval_seconds: float = float(os.getenv("CHANGE_FEED_PRUNE_INTERVAL_SECONDS", "600"))
+    change_feed_gap_grace_seconds: float = float(os.getenv("CHANGE_FEED_GAP_GRACE_SECONDS", "10"))
 
 
 settings = Settings()
@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+from urllib.parse import urljoin, urlparse
+
+import requests
+from starlette.concurrency import run_in_threadpool
+
+from app.config import settings
+from app.cpu_pool import run_cpu_bound
+
+# In-flight fetches by URL hash; every request for the same cover awaits the one task.
+_fetches: dict[str, asyncio.Task] = {}
+_cache_bytes: int | None = None
+_cache_lock = threading.Lock()
+
+
+def cover_sizes() -> tuple[int, ...]:
+    return tuple(sorted(settings.cover_sizes))
+
+
+def pick_size(requested: int) -> int:
+    sizes = cover_sizes()
+    for size in sizes:
+        if size >= requested:
+            return size
+    return sizes[-1]
+
+
+def cover_etag(url: str, size: int) -> str:
+    return f'"{hashlib.sha256(url.encode("utf-8")).hexdigest()[:24]}-{size}"'
+
+
+def _cache_path(url: str, size: int) -> str:
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(settings.cover_cache_dir, key[:2], f"{key}_{size}.jpg")
+
+
+def render_thumbnails(data: bytes, sizes: tuple[int, ...]) -> dict[int, bytes]:
+    # Runs in a worker process.
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as source:
+        image = source.convert("RGB")
+    result: dict[int, bytes] = {}
+    for size in sorted(sizes, reverse=True):
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=85, optimize=True)
+        result[size] = out.getvalue()
+    return result
+
+
+def _check_public_url(url: str):
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("Cover URL must be http(s)")
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    for info in socket.getaddrinfo(parsed.hostname, port, proto=socket.IPPROTO_TCP):
+        address = ipaddress.ip_address(info[4][0])
+        if not address.is_global:
+            raise ValueError("Cover URL points to a non-public address")
+
+
+def fetch_source(url: str) -> bytes:
+    for _ in range(4):
+        _check_public_url(url)
+        response = requests.get(
+            url,
+            timeout=settings.cover_fetch_timeout_seconds,
+            stream=True,
+            allow_redirects=False,
+        )
+        if response.is_redirect:
+            url = urljoin(url, response.headers.get("location", ""))
+            response.close()
+            continue
+        if response.status_code >= 300:
+            raise RuntimeError(f"Cover fetch failed: {response.status_code}")
+        data = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            data.extend(chunk)
+            if len(data) > settings.cover_max_source_bytes:
+                response.close()
+                raise ValueError("Cover source is too large")
+        return bytes(data)
+    raise RuntimeError("Cover fetch failed: too many redirects")
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as handle:
+        handle.write(data)
+    os.replace(tmp_path, path)
+
+
+def _scan_cache() -> list[tuple[float, int, str]]:
+    entries = []
+    for root, _, files in os.walk(settings.cover_cache_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def _store(thumbnails: dict[int, bytes], url: str):
+    global _cache_bytes
+    for size, data in thumbnails.items():
+        _write_atomic(_cache_path(url, size), data)
+
+    with _cache_lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(size for _, size, _ in _scan_cache())
+        else:
+            _cache_bytes += sum(len(data) for data in thumbnails.values())
+        if _cache_bytes <= settings.cover_cache_max_bytes:
+            return
+        # Least recently served first (hits bump mtime); trim to 90% to avoid evicting on every miss.
+        entries = sorted(_scan_cache())
+        total = sum(size for _, size, _ in entries)
+        target = settings.cover_cache_max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        _cache_bytes = total
+
+
+def _cached(path: str) -> bool:
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+async def _fetch_and_store(url: str):
+    # One fetch produces every fixed size, so other sizes of this cover are hits later.
+    data = await run_in_threadpool(fetch_source, url)
+    thumbnails = await run_cpu_bound(render_thumbnails, data, cover_sizes())
+    await run_in_threadpool(_store, thumbnails, url)
+
+
+def _fetch_done(key: str, task: asyncio.Task):
+    _fetches.pop(key, None)
+    if not task.cancelled():
+        # Retrieved here too, in case every waiter disconnected before it finished.
+        task.exception()
+
+
+async def get_cover_path(url: str, size: int) -> str:
+    path = _cache_path(url, size)
+    if await run_in_threadpool(_cached, path):
+        return path
+
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    task = _fetches.get(key)
+    if task is None:
+        task = asyncio.get_running_loop().create_task(_fetch_and_store(url))
+        _fetches[key] = task
+        task.add_done_callback(lambda done: _fetch_done(key, done))
+    # Shielded so a client that disconnects does not cancel the fetch the others are waiting on.
+    await asyncio.shield(task)
+    return path
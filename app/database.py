@@ -1,7 +1,11 @@
 ﻿from __future__ import annotations
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import DeclarativeBase, sessionmaker
+import hashlib
+import time
+
+from sqlalchemy import create_engine, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import DeclarativeBase, Session, sessionmaker
 
 from app.config import settings
 
@@ -10,13 +14,137 @@ class Base(DeclarativeBase):
     pass
 
 
+def _create_engine(database_url: str):
+    is_sqlite = database_url.startswith("sqlite")
+    return create_engine(
+        database_url,
+        connect_args={"check_same_thread": False} if is_sqlite else {},
+        pool_pre_ping=True,
+        **({} if is_sqlite else {"pool_size": settings.db_pool_size, "max_overflow": settings.db_max_overflow}),
+    )
+
+
 is_sqlite = settings.database_url.startswith("sqlite")
-engine = create_engine(
-    settings.database_url,
-    connect_args={"check_same_thread": False} if is_sqlite else {},
-)
+engine = _create_engine(settings.database_url)
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 
+# Per-user library tables live on one of these shards; users, the shard directory and storage
+# replicas stay in the main database. Without DATABASE_SHARD_URLS the main database is the only shard.
+shard_engines = [
+    engine if url == settings.database_url else _create_engine(url) for url in settings.database_shard_urls
+] or [engine]
+shard_sessions = [sessionmaker(bind=shard_engine, autocommit=False, autoflush=False) for shard_engine in shard_engines]
+
+SHARD_ACTIVE = "active"
+SHARD_MOVING = "moving"
+
+_directory: dict[int, tuple[int, str, float]] = {}
+_mirrored: set[tuple[int, int]] = set()
+
+
+class ShardUnavailable(RuntimeError):
+    pass
+
+
+def hash_shard(user_id: int) -> int:
+    digest = hashlib.sha256(str(user_id).encode("ascii")).digest()
+    return int.from_bytes(digest[:8], "big") % len(shard_engines)
+
+
+def lookup_shard(user_id: int) -> tuple[int, str]:
+    from app.models import UserShard
+
+    db = SessionLocal()
+    try:
+        row = db.get(UserShard, user_id)
+        if row is None:
+            # The first library access pins the hashed shard, so adding shards later moves nobody.
+            db.add(UserShard(user_id=user_id, shard=hash_shard(user_id), state=SHARD_ACTIVE))
+            try:
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+            row = db.get(UserShard, user_id)
+        return row.shard, row.state
+    finally:
+        db.close()
+
+
+def shard_for_user(user_id: int) -> int:
+    if len(shard_engines) == 1:
+        return 0
+    cached = _directory.get(user_id)
+    if cached is not None and time.monotonic() - cached[2] < settings.shard_directory_ttl_seconds:
+        shard, state = cached[0], cached[1]
+    else:
+        # Cached briefly per process; the rebalancer waits out this TTL before copying rows.
+        shard, state = lookup_shard(user_id)
+        _directory[user_id] = (shard, state, time.monotonic())
+    if state != SHARD_ACTIVE:
+        raise ShardUnavailable(f"Library of user {user_id} is being moved, retry shortly")
+    if shard >= len(shard_engines):
+        raise RuntimeError(f"User {user_id} is on shard {shard}, but only {len(shard_engines)} are configured")
+    return shard
+
+
+def forget_shard(user_id: int):
+    _directory.pop(user_id, None)
+
+
+def mirror_user(shard: int, user_id: int):
+    # Library rows reference users.id, so every shard keeps a copy of its users' rows.
+    if shard_engines[shard] is engine or (shard, user_id) in _mirrored:
+        return
+    from app.models import User
+
+    users = User.__table__
+    with engine.connect() as conn:
+        row = conn.execute(select(users).where(users.c.id == user_id)).mappings().first()
+    if row is None:
+        return
+    try:
+        with shard_engines[shard].begin() as conn:
+            if conn.execute(select(users.c.id).where(users.c.id == user_id)).first() is None:
+                conn.execute(insert(users), [dict(row)])
+    except IntegrityError:
+        pass
+    _mirrored.add((shard, user_id))
+
+
+def library_session(user_id: int) -> Session:
+    shard = shard_for_user(user_id)
+    mirror_user(shard, user_id)
+    return shard_sessions[shard]()
+
+
+def upsert_increment(db: Session, model, rows: list[dict], counters: tuple[str, ...]):
+    # Insert rows keyed by the model's primary key; on conflict add `counters` onto the stored values.
+    if not rows:
+        return
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(model)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[col.name for col in model.__table__.primary_key.columns],
+            set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in counters},
+        )
+        db.execute(stmt, rows)
+        return
+
+    key_names = [col.name for col in model.__table__.primary_key.columns]
+    for row in rows:
+        updated = db.execute(
+            update(model)
+            .where(*(getattr(model, name) == row[name] for name in key_names))
+            .values({name: getattr(model, name) + row[name] for name in counters})
+        )
+        if updated.rowcount == 0:
+            db.execute(insert(model).values(**row))
+
 
 def get_db():
     db = SessionLocal()
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import hashlib
+from collections import defaultdict
+
+from sqlalchemy import delete, event, insert, select
+from sqlalchemy.orm import Session
+
+from app.database import upsert_increment
+from app.models import LibraryTrack, LibrarySyncBucket
+from app.serialization import TRACK_COLUMNS
+
+# Part of the wire protocol: clients bucket and hash exactly the same way, so these are not settings.
+SYNC_BUCKETS = 256
+DIGEST_MOD = 1 << 48
+
+# Row (user 0, bucket -1) records which row_hash format the stored digests use; no user has id 0.
+HASH_FORMAT = 2
+_FORMAT_KEY = (0, -1)
+
+_DELTAS_KEY = "library_sync_deltas"
+_DIRTY_KEY = "library_sync_dirty"
+
+
+def row_hash(row) -> int:
+    # Every field the client receives, in TrackOut order, so a reused id with a reset version still differs.
+    values = (getattr(row, column.key) for column in TRACK_COLUMNS)
+    fields = "\x1f".join("" if value is None else str(value) for value in values)
+    return int.from_bytes(hashlib.sha256(fields.encode("utf-8")).digest()[:6], "big")
+
+
+def bucket_of(track_id: int) -> int:
+    return track_id % SYNC_BUCKETS
+
+
+def _add(deltas: dict, user_id: int, track_id: int, digest: int, count: int):
+    delta = deltas[(user_id, bucket_of(track_id))]
+    delta[0] += digest
+    delta[1] += count
+
+
+@event.listens_for(Session, "before_flush")
+def _track_version_changes(session: Session, flush_context, instances):
+    # Recomputed per flush, so deltas from a flush that failed (e.g. StaleDataError) are dropped.
+    deltas: dict[tuple[int, int], list[int]] = defaultdict(lambda: [0, 0])
+    session.info[_DELTAS_KEY] = deltas
+    dirty = [
+        obj
+        for obj in session.dirty
+        if isinstance(obj, LibraryTrack) and session.is_modified(obj, include_collections=False)
+    ]
+    session.info[_DIRTY_KEY] = dirty
+    deleted = [obj for obj in session.deleted if isinstance(obj, LibraryTrack)]
+    if not dirty and not deleted:
+        return
+    # Old hashes come from the rows as stored, since the objects already hold the new values.
+    ids = {obj.id for obj in dirty + deleted}
+    for row in session.execute(select(LibraryTrack.user_id, *TRACK_COLUMNS).where(LibraryTrack.id.in_(ids))):
+        _add(deltas, row.user_id, row.id, -row_hash(row), 0)
+    for obj in deleted:
+        _add(deltas, obj.user_id, obj.id, 0, -1)
+
+
+@event.listens_for(Session, "after_flush")
+def _apply_bucket_deltas(session: Session, flush_context):
+    deltas = session.info.pop(_DELTAS_KEY, None)
+    dirty = session.info.pop(_DIRTY_KEY, ())
+    if deltas is None:
+        return
+    # session.new still lists pre-flush pending rows here, now with their ids assigned.
+    for obj in session.new:
+        if isinstance(obj, LibraryTrack):
+            _add(deltas, obj.user_id, obj.id, row_hash(obj), 1)
+    # Flushed by now, so these carry the bumped version.
+    for obj in dirty:
+        _add(deltas, obj.user_id, obj.id, row_hash(obj), 0)
+    rows = [
+        {"user_id": user_id, "bucket": bucket, "digest": digest, "count": count}
+        for (user_id, bucket), (digest, count) in deltas.items()
+        if digest or count
+    ]
+    upsert_increment(session, LibrarySyncBucket, rows, counters=("digest", "count"))
+
+
+def rebuild_sync_buckets(db: Session, user_id: int | None = None):
+    # Full recompute for rows written outside the ORM (restore) or before versioning existed.
+    stmt = select(LibraryTrack.user_id, *TRACK_COLUMNS)
+    clear = delete(LibrarySyncBucket)
+    if user_id is not None:
+        stmt = stmt.where(LibraryTrack.user_id == user_id)
+        clear = clear.where(LibrarySyncBucket.user_id == user_id)
+
+    totals: dict[tuple[int, int], list[int]] = defaultdict(lambda: [0, 0])
+    result = db.execute(stmt, execution_options={"stream_results": True, "yield_per": 1000})
+    for row in result:
+        total = totals[(row.user_id, bucket_of(row.id))]
+        total[0] += row_hash(row)
+        total[1] += 1
+
+    db.execute(clear)
+    rows = [
+        {"user_id": uid, "bucket": bucket, "digest": digest, "count": count}
+        for (uid, bucket), (digest, count) in totals.items()
+    ]
+    if user_id is None:
+        rows.append({"user_id": _FORMAT_KEY[0], "bucket": _FORMAT_KEY[1], "digest": HASH_FORMAT, "count": 0})
+    if rows:
+        db.execute(insert(LibrarySyncBucket), rows)
+    db.commit()
+
+
+def ensure_sync_buckets(db: Session):
+    # Digests stored by an older row_hash (or none at all) are recomputed once.
+    marker = db.get(LibrarySyncBucket, _FORMAT_KEY)
+    if marker is None or marker.digest != HASH_FORMAT:
+        rebuild_sync_buckets(db)
+
+
+def server_manifest(db: Session, user_id: int) -> dict[int, tuple[int, int]]:
+    rows = db.query(LibrarySyncBucket).filter(LibrarySyncBucket.user_id == user_id).all()
+    return {row.bucket: (row.digest % DIGEST_MOD, row.count) for row in rows if row.count}
+
+
+def manifest_root(manifest: dict[int, tuple[int, int]]) -> int:
+    return sum(digest for digest, _ in manifest.values()) % DIGEST_MOD
+
+
+def differing_buckets(manifest: dict[int, tuple[int, int]], client: dict[int, int]) -> list[int]:
+    client = {bucket: digest % DIGEST_MOD for bucket, digest in client.items()}
+    buckets = set(manifest) | set(client)
+    return sorted(
+        bucket
+        for bucket in buckets
+        if 0 <= bucket < SYNC_BUCKETS and manifest.get(bucket, (0, 0))[0] != client.get(bucket, 0)
+    )
@@ -1,8 +1,8 @@
 ﻿from __future__ import annotations
 
-from datetime import datetime
+from datetime import date, datetime
 
-from sqlalchemy import Boolean, DateTime, ForeignKey, Integer, String, Text
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Float, ForeignKey, Index, Integer, LargeBinary, SmallInteger, String, Text, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.database import Base
@@ -25,6 +25,8 @@ class User(Base):
 
 class LibraryTrack(Base):
     __tablename__ = "library_tracks"
+    # Never hand a deleted track's id to a new one (SQLite reuses the highest rowid otherwise).
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
@@ -37,10 +39,144 @@ class LibraryTrack(Base):
     duration_ms: Mapped[int] = mapped_column(Integer, default=0)
 
     remote_file_key: Mapped[str | None] = mapped_column(Text, nullable=True)
+    # Set only for objects this server uploaded; such rows count towards the user's storage usage.
+    size_bytes: Mapped[int] = mapped_column(BigInteger, default=0)
+    content_hash: Mapped[str | None] = mapped_column(String(64), nullable=True)
     cover_url: Mapped[str | None] = mapped_column(Text, nullable=True)
 
     play_count: Mapped[int] = mapped_column(Integer, default=0)
     skip_count: Mapped[int] = mapped_column(Integer, default=0)
+    last_played_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Bumped by the ORM on every UPDATE (guarded by WHERE version = old); feeds the sync manifest.
+    version: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
 
-    user: Mapped[User] = relationship(back_populates="tracks")
+    user: Mapped[User] = relationship(back_populates="tracks")
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+class PlayEvent(Base):
+    __tablename__ = "play_events"
+    __table_args__ = (Index("ix_play_events_user_ts", "user_id", "ts"),)
+
+    # Append-only: no FKs or extra indexes so batched inserts stay cheap.
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer)
+    track_id: Mapped[int] = mapped_column(Integer)
+    kind: Mapped[int] = mapped_column(SmallInteger)
+    ts: Mapped[datetime] = mapped_column(DateTime)
+
+
+class PlayRollupDaily(Base):
+    __tablename__ = "play_rollups_daily"
+
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    track_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    plays: Mapped[int] = mapped_column(Integer, default=0)
+    skips: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class PlayRollupWeekly(Base):
+    __tablename__ = "play_rollups_weekly"
+
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    week_start: Mapped[date] = mapped_column(Date, primary_key=True)
+    track_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    plays: Mapped[int] = mapped_column(Integer, default=0)
+    skips: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class Playlist(Base):
+    __tablename__ = "playlists"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    name: Mapped[str] = mapped_column(String(512))
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    items: Mapped[list[PlaylistItem]] = relationship(back_populates="playlist", cascade="all, delete-orphan")
+
+
+class PlaylistItem(Base):
+    __tablename__ = "playlist_items"
+    __table_args__ = (Index("ix_playlist_items_playlist_rank", "playlist_id", "rank", "id"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    playlist_id: Mapped[int] = mapped_column(ForeignKey("playlists.id"))
+    track_id: Mapped[int] = mapped_column(ForeignKey("library_tracks.id"), index=True)
+    # Fractional position: inserting between two items takes the midpoint of their ranks.
+    rank: Mapped[float] = mapped_column(Float)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    playlist: Mapped[Playlist] = relationship(back_populates="items")
+
+
+class StorageObjectReplica(Base):
+    __tablename__ = "storage_object_replicas"
+    __table_args__ = (UniqueConstraint("object_key", "backend", name="uq_storage_object_replica"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    object_key: Mapped[str] = mapped_column(String(1024), index=True)
+    backend: Mapped[str] = mapped_column(String(32))
+    backend_key: Mapped[str] = mapped_column(String(1024))
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class UserShard(Base):
+    __tablename__ = "user_shards"
+
+    # Directory of library shards; only the copy in the main database is consulted.
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    shard: Mapped[int] = mapped_column(Integer)
+    state: Mapped[str] = mapped_column(String(16), default="active")
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class UserStorageUsage(Base):
+    __tablename__ = "user_storage_usage"
+
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    bytes_used: Mapped[int] = mapped_column(BigInteger, default=0)
+    object_count: Mapped[int] = mapped_column(Integer, default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class TrackWaveform(Base):
+    __tablename__ = "track_waveforms"
+
+    track_id: Mapped[int] = mapped_column(ForeignKey("library_tracks.id"), primary_key=True)
+    status: Mapped[str] = mapped_column(String(16))
+    # Comma-separated, ascending; `peaks` holds int8 (min, max) pairs for each resolution in that order.
+    resolutions: Mapped[str] = mapped_column(String(128), default="")
+    peaks: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+
+class LibrarySyncBucket(Base):
+    __tablename__ = "library_sync_buckets"
+
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    bucket: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # Plain sum of the 48-bit row hashes in the bucket; compared modulo 2**48.
+    digest: Mapped[int] = mapped_column(BigInteger, default=0)
+    count: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class LibraryChange(Base):
+    __tablename__ = "library_changes"
+    # AUTOINCREMENT keeps SQLite from restarting ids after the log is pruned empty.
+    __table_args__ = (Index("ix_library_changes_user_id_id", "user_id", "id"), {"sqlite_autoincrement": True})
+
+    # The id doubles as the SSE event id, so it must only ever grow.
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(Integer)
+    kind: Mapped[str] = mapped_column(String(32))
+    track_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    payload: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
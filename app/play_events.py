@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import ShardUnavailable, shard_for_user, shard_sessions, upsert_increment
+from app.models import LibraryTrack, PlayEvent, PlayRollupDaily, PlayRollupWeekly
+
+logger = logging.getLogger(__name__)
+
+PLAY = 1
+SKIP = 2
+
+# (shard, event): track ids are only meaningful on the shard they were read from.
+_buffer: list[tuple[int, dict]] = []
+_buffer_lock = threading.Lock()
+_flush_requested = threading.Event()
+_stop = threading.Event()
+_flusher: threading.Thread | None = None
+
+
+def week_start(day):
+    return day - timedelta(days=day.weekday())
+
+
+def record_play_events(
+    shard: int,
+    user_id: int,
+    track_id: int,
+    plays: int = 0,
+    skips: int = 0,
+    ts: datetime | None = None,
+):
+    # `shard` is the one the caller read track_id from; it is not looked up again here, since the
+    # library may have started moving after the counters were committed.
+    if plays <= 0 and skips <= 0:
+        return
+    ts = ts or datetime.utcnow()
+    events = [{"user_id": user_id, "track_id": track_id, "kind": PLAY, "ts": ts}] * max(0, plays)
+    events += [{"user_id": user_id, "track_id": track_id, "kind": SKIP, "ts": ts}] * max(0, skips)
+    with _buffer_lock:
+        accepted = events[: max(0, settings.play_events_max_buffer - len(_buffer))]
+        _buffer.extend((shard, event) for event in accepted)
+        pending = len(_buffer)
+    if len(accepted) < len(events):
+        logger.warning(
+            "Play event buffer is full (%d); dropped %d events for user %s",
+            settings.play_events_max_buffer,
+            len(events) - len(accepted),
+            user_id,
+        )
+    if pending >= settings.play_events_batch_size:
+        _flush_requested.set()
+
+
+def delete_track_plays(db: Session, user_id: int, track_id: int):
+    # Part of the track delete's transaction, so a later track given the same id starts from zero.
+    for model in (PlayEvent, PlayRollupDaily, PlayRollupWeekly):
+        db.execute(delete(model).where(model.user_id == user_id, model.track_id == track_id))
+
+
+def discard_play_events(shard: int, user_id: int, track_id: int):
+    with _buffer_lock:
+        _buffer[:] = [
+            (event_shard, event)
+            for event_shard, event in _buffer
+            if not (event_shard == shard and event["user_id"] == user_id and event["track_id"] == track_id)
+        ]
+
+
+def _rollup_rows(events: list[dict]) -> tuple[list[dict], list[dict]]:
+    daily: dict[tuple, list[int]] = defaultdict(lambda: [0, 0])
+    for event in events:
+        counts = daily[(event["user_id"], event["ts"].date(), event["track_id"])]
+        counts[0 if event["kind"] == PLAY else 1] += 1
+
+    weekly: dict[tuple, list[int]] = defaultdict(lambda: [0, 0])
+    for (user_id, day, track_id), (plays, skips) in daily.items():
+        counts = weekly[(user_id, week_start(day), track_id)]
+        counts[0] += plays
+        counts[1] += skips
+
+    return (
+        [
+            {"user_id": u, "day": d, "track_id": t, "plays": p, "skips": s}
+            for (u, d, t), (p, s) in daily.items()
+        ],
+        [
+            {"user_id": u, "week_start": w, "track_id": t, "plays": p, "skips": s}
+            for (u, w, t), (p, s) in weekly.items()
+        ],
+    )
+
+
+def _current_shards(user_ids: set[int]) -> dict[int, int | None]:
+    # None: the library is being moved. Users whose lookup failed are left out and retried next time.
+    shards = {}
+    for user_id in user_ids:
+        try:
+            shards[user_id] = shard_for_user(user_id)
+        except ShardUnavailable:
+            shards[user_id] = None
+        except Exception:
+            logger.exception("Could not look up the shard of user %s; keeping their play events", user_id)
+    return shards
+
+
+def _requeue(events: list[tuple[int, dict]]):
+    with _buffer_lock:
+        kept = events[: max(0, settings.play_events_max_buffer - len(_buffer))]
+        _buffer[:0] = kept
+    if len(kept) < len(events):
+        logger.warning(
+            "Play event buffer is full (%d); dropped %d re-queued events",
+            settings.play_events_max_buffer,
+            len(events) - len(kept),
+        )
+
+
+def _write_events(shard: int, events: list[dict]) -> int:
+    db = shard_sessions[shard]()
+    try:
+        # Locked so a concurrent track delete cannot slip in between; events for deleted tracks are dropped.
+        existing = set(
+            db.execute(
+                select(LibraryTrack.user_id, LibraryTrack.id)
+                .where(LibraryTrack.id.in_({event["track_id"] for event in events}))
+                .with_for_update()
+            ).all()
+        )
+        events = [event for event in events if (event["user_id"], event["track_id"]) in existing]
+        if not events:
+            db.rollback()
+            return 0
+        daily_rows, weekly_rows = _rollup_rows(events)
+        # Events and their rollup increments commit together, so rollups never drift.
+        db.execute(insert(PlayEvent), events)
+        upsert_increment(db, PlayRollupDaily, daily_rows, counters=("plays", "skips"))
+        upsert_increment(db, PlayRollupWeekly, weekly_rows, counters=("plays", "skips"))
+        db.commit()
+        return len(events)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def flush_play_events() -> int:
+    with _buffer_lock:
+        pending = _buffer[:]
+        _buffer.clear()
+    if not pending:
+        return 0
+
+    current = _current_shards({event["user_id"] for _, event in pending})
+    by_shard: dict[int, list[dict]] = defaultdict(list)
+    retry: list[tuple[int, dict]] = []
+    dropped = 0
+    for shard, event in pending:
+        if event["user_id"] not in current:
+            retry.append((shard, event))
+            continue
+        target = current[event["user_id"]]
+        if target is not None and target != shard:
+            # Library moved and was renumbered, so these track ids no longer mean anything.
+            dropped += 1
+        else:
+            # Mid-move events still go to the source shard: the move's grace period covers this flush,
+            # and a write that lands after its snapshot aborts the move instead of being lost.
+            by_shard[shard].append(event)
+    if dropped:
+        logger.warning("Dropped %d play events for libraries that moved shards", dropped)
+
+    written = 0
+    for shard, events in by_shard.items():
+        try:
+            written += _write_events(shard, events)
+        except Exception:
+            logger.exception("Failed to flush %d play events to shard %d; re-queueing", len(events), shard)
+            retry.extend((shard, event) for event in events)
+    if retry:
+        _requeue(retry)
+    return written
+
+
+def _flush_loop():
+    while not _stop.is_set():
+        _flush_requested.wait(timeout=settings.play_events_flush_seconds)
+        _flush_requested.clear()
+        try:
+            flush_play_events()
+        except Exception:
+            # The thread must survive, or every later event would pile up until the buffer cap drops it.
+            logger.exception("Play event flush failed")
+
+
+def start_play_event_writer():
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    _stop.clear()
+    _flusher = threading.Thread(target=_flush_loop, name="play-events-writer", daemon=True)
+    _flusher.start()
+
+
+def stop_play_event_writer():
+    global _flusher
+    _stop.set()
+    _flush_requested.set()
+    if _flusher is not None:
+        _flusher.join(timeout=10)
+        _flusher = None
+    flush_play_events()
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import tempfile
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from app.admission import controller as admission_controller
+from app.backup import format_checkpoint, gzip_chunks, iter_export_lines, iter_lines, parse_checkpoint, restore_lines
+from app.config import settings
+from app.database import SessionLocal, shard_sessions
+from app.models import User
+from app.security import get_admin_user
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+
+def _session_factory(shard: int | None):
+    # Without ?shard= the main database; with shards configured, back up each shard separately.
+    if shard is None:
+        return SessionLocal
+    if not 0 <= shard < len(shard_sessions):
+        raise HTTPException(status_code=400, detail=f"Unknown shard, {len(shard_sessions)} configured")
+    return shard_sessions[shard]
+
+
+def _export_stream(session_factory, gzip: bool):
+    db = session_factory()
+    try:
+        lines = iter_export_lines(db, batch_size=settings.backup_batch_size)
+        yield from gzip_chunks(lines) if gzip else lines
+    finally:
+        db.close()
+
+
+def _read_chunks(handle, size: int = 1024 * 1024):
+    handle.seek(0)
+    while chunk := handle.read(size):
+        yield chunk
+
+
+@router.get("/admission")
+def admission_status(_: User = Depends(get_admin_user)):
+    return admission_controller.stats()
+
+
+@router.get("/export")
+def export_library(gzip: bool = False, shard: int | None = None, _: User = Depends(get_admin_user)):
+    session_factory = _session_factory(shard)
+    filename = "toporch_export.ndjson" + (".gz" if gzip else "")
+    return StreamingResponse(
+        _export_stream(session_factory, gzip),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.post("/restore")
+async def restore_library(
+    request: Request,
+    resume: str | None = None,
+    shard: int | None = None,
+    _: User = Depends(get_admin_user),
+):
+    session_factory = _session_factory(shard)
+    progress = {"checkpoint": parse_checkpoint(resume)}
+
+    def remember(checkpoint: dict[str, int]):
+        progress["checkpoint"] = checkpoint
+
+    # Spool the body to disk so memory stays flat, then insert in batched transactions off the loop.
+    with tempfile.SpooledTemporaryFile(max_size=settings.storage_spool_max_memory) as spool:
+        async for chunk in request.stream():
+            await run_in_threadpool(spool.write, chunk)
+        try:
+            return await run_in_threadpool(
+                restore_lines,
+                session_factory,
+                iter_lines(_read_chunks(spool)),
+                settings.backup_batch_size,
+                progress["checkpoint"],
+                remember,
+            )
+        except Exception as exc:
+            raise HTTPException(
+                status_code=409,
+                detail={"error": str(exc), "resume": format_checkpoint(progress["checkpoint"])},
+            ) from exc
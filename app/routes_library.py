@@ -1,46 +1,120 @@
 ﻿from __future__ import annotations
 
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
-from fastapi.responses import Response
+import logging
+import os
+from datetime import datetime
+
+from fastapi import APIRouter, BackgroundTasks, Depends, File, Header, HTTPException, Query, UploadFile
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
+from starlette.concurrency import run_in_threadpool
 
-from app.database import get_db
-from app.models import LibraryTrack, User
-from app.schemas import TrackCountersUpdate, TrackCreate, TrackOut
-from app.security import get_current_user
+from app.change_feed import (
+    COUNTERS_CHANGED,
+    TRACK_ADDED,
+    TRACK_DELETED,
+    TRACK_UPDATED,
+    broker,
+    changes_since,
+    is_expired,
+    record_track_change,
+    stream_changes,
+    visible_change_id,
+)
+from app.config import settings
+from app.covers import cover_etag, get_cover_path, pick_size
+from app.library_sync import SYNC_BUCKETS, differing_buckets, manifest_root, server_manifest
+from app.models import LibraryTrack, PlaylistItem, TrackWaveform, User
+from app.play_events import delete_track_plays, discard_play_events, record_play_events
+from app.schemas import (
+    LibraryChangesPage,
+    LibrarySyncRequest,
+    LibrarySyncResponse,
+    StorageUsageOut,
+    TrackCountersUpdate,
+    TrackCreate,
+    TrackOut,
+    TrackUpdate,
+)
+from app.security import get_current_user, get_library_db, get_library_shard
+from app.serialization import TRACK_COLUMNS, json_response, track_dict
+from app.smart_shuffle import on_track_changed, on_track_removed, sample_tracks
 from app.storage_factory import get_storage
+from app.storage_usage import (
+    count_uploaded_object,
+    get_usage,
+    measure_stream,
+    release_reservation,
+    release_uploaded_object,
+    reserve_bytes,
+)
+from app.waveform import (
+    FAILED,
+    is_retryable,
+    pick_resolution,
+    schedule_waveform,
+    slice_peaks,
+    spool_to_temp,
+    stored_resolutions,
+    waveform_etag,
+)
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/me/library", tags=["library"])
 
 
+def _track_out(row: LibraryTrack) -> TrackOut:
+    return TrackOut(
+        id=row.id,
+        path=row.path,
+        filename=row.filename,
+        title=row.title,
+        artist=row.artist,
+        album=row.album,
+        duration_ms=row.duration_ms,
+        remote_file_key=row.remote_file_key,
+        cover_url=row.cover_url,
+        play_count=row.play_count,
+        skip_count=row.skip_count,
+        size_bytes=row.size_bytes or 0,
+        content_hash=row.content_hash,
+        version=row.version,
+    )
+
+
 @router.get("/tracks", response_model=list[TrackOut])
-def get_tracks(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_tracks(user: User = Depends(get_current_user), db: Session = Depends(get_library_db)):
     rows = (
-        db.query(LibraryTrack)
+        db.query(*TRACK_COLUMNS)
         .filter(LibraryTrack.user_id == user.id)
         .order_by(LibraryTrack.id.desc())
         .all()
     )
-    return [
-        TrackOut(
-            id=row.id,
-            path=row.path,
-            filename=row.filename,
-            title=row.title,
-            artist=row.artist,
-            album=row.album,
-            duration_ms=row.duration_ms,
-            remote_file_key=row.remote_file_key,
-            cover_url=row.cover_url,
-            play_count=row.play_count,
-            skip_count=row.skip_count,
-        )
-        for row in rows
-    ]
+    return json_response([track_dict(row) for row in rows])
+
+
+@router.get("/shuffle", response_model=list[TrackOut])
+def smart_shuffle(
+    limit: int = Query(20, ge=1, le=200),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    track_ids = sample_tracks(db, user.id, limit)
+    if not track_ids:
+        return []
+    rows = {
+        row.id: row
+        for row in db.query(LibraryTrack)
+        .filter(LibraryTrack.user_id == user.id, LibraryTrack.id.in_(track_ids))
+        .all()
+    }
+    return [_track_out(rows[track_id]) for track_id in track_ids if track_id in rows]
 
 
 @router.post("/tracks", response_model=TrackOut)
-def add_track(payload: TrackCreate, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def add_track(payload: TrackCreate, user: User = Depends(get_current_user), db: Session = Depends(get_library_db)):
     row = LibraryTrack(
         user_id=user.id,
         path=payload.path,
@@ -53,20 +127,151 @@ def add_track(payload: TrackCreate, user: User = Depends(get_current_user), db:
         cover_url=payload.cover_url,
     )
     db.add(row)
+    db.flush()
+    record_track_change(db, row, TRACK_ADDED)
     db.commit()
     db.refresh(row)
-    return TrackOut(
-        id=row.id,
-        path=row.path,
-        filename=row.filename,
-        title=row.title,
-        artist=row.artist,
-        album=row.album,
-        duration_ms=row.duration_ms,
-        remote_file_key=row.remote_file_key,
-        cover_url=row.cover_url,
-        play_count=row.play_count,
-        skip_count=row.skip_count,
+    on_track_changed(row)
+    broker.notify()
+    return _track_out(row)
+
+
+@router.patch("/tracks/{track_id}", response_model=TrackOut)
+def update_track(
+    track_id: int,
+    payload: TrackUpdate,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    row = _get_user_track(db, user, track_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Track not found")
+
+    for field, value in payload.model_dump(exclude_unset=True).items():
+        setattr(row, field, value)
+    try:
+        record_track_change(db, row, TRACK_UPDATED)
+        db.commit()
+    except StaleDataError as exc:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Track was modified concurrently, retry") from exc
+    db.refresh(row)
+    broker.notify()
+    return _track_out(row)
+
+
+def _delete_stored_object(file_id: str):
+    try:
+        get_storage().delete_file(file_id)
+    except Exception:
+        logger.exception("Failed to delete stored object %s", file_id)
+
+
+@router.delete("/tracks/{track_id}")
+def delete_track(
+    track_id: int,
+    background_tasks: BackgroundTasks,
+    user: User = Depends(get_current_user),
+    shard: int = Depends(get_library_shard),
+    db: Session = Depends(get_library_db),
+):
+    row = _get_user_track(db, user, track_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Track not found")
+
+    # Only objects this server uploaded (content_hash set) are owned by the row and counted in usage.
+    owned_file_id = row.remote_file_key if row.content_hash else None
+    db.query(PlaylistItem).filter(PlaylistItem.track_id == row.id).delete(synchronize_session=False)
+    db.query(TrackWaveform).filter(TrackWaveform.track_id == row.id).delete(synchronize_session=False)
+    delete_track_plays(db, user.id, row.id)
+    if owned_file_id:
+        release_uploaded_object(db, row)
+    try:
+        record_track_change(db, row, TRACK_DELETED)
+        db.delete(row)
+        db.commit()
+    except StaleDataError as exc:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Track was modified concurrently, retry") from exc
+    discard_play_events(shard, user.id, track_id)
+    on_track_removed(user.id, track_id)
+    broker.notify()
+    if owned_file_id:
+        background_tasks.add_task(_delete_stored_object, owned_file_id)
+    return {"ok": True}
+
+
+@router.get("/usage", response_model=StorageUsageOut)
+def get_storage_usage(user: User = Depends(get_current_user), db: Session = Depends(get_library_db)):
+    return get_usage(db, user.id)
+
+
+@router.get("/changes", response_model=LibraryChangesPage)
+def get_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=1000),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    # Polling fallback for clients that cannot hold an SSE connection open.
+    if is_expired(db, since):
+        return {"changes": [], "last_id": visible_change_id(db), "reset": True}
+    until = visible_change_id(db, since)
+    changes = changes_since(db, user.id, since, until, limit)
+    last_id = changes[-1]["id"] if len(changes) >= limit else until
+    return {"changes": changes, "last_id": last_id}
+
+
+@router.get("/changes/stream")
+async def stream_library_changes(
+    since: int | None = Query(None, ge=0),
+    last_event_id: str | None = Header(default=None),
+    user: User = Depends(get_current_user),
+    shard: int = Depends(get_library_shard),
+):
+    # EventSource reconnects send Last-Event-ID; ?since= lets a client resume from a stored cursor.
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    return StreamingResponse(
+        stream_changes(user.id, shard, -1 if since is None else since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/sync", response_model=LibrarySyncResponse)
+def sync_library(payload: LibrarySyncRequest, user: User = Depends(get_current_user), db: Session = Depends(get_library_db)):
+    # Client sends per-bucket digests of its copy; only buckets that differ come back, in full.
+    manifest = server_manifest(db, user.id)
+    root = manifest_root(manifest)
+    if payload.root is not None and payload.root == root:
+        return json_response({"bucket_count": SYNC_BUCKETS, "root": root, "buckets": []})
+
+    buckets = differing_buckets(manifest, payload.buckets)
+    tracks: dict[int, list[dict]] = {bucket: [] for bucket in buckets}
+    if buckets:
+        rows = (
+            db.query(*TRACK_COLUMNS)
+            .filter(LibraryTrack.user_id == user.id, (LibraryTrack.id % SYNC_BUCKETS).in_(buckets))
+            .order_by(LibraryTrack.id)
+            .all()
+        )
+        for row in rows:
+            tracks[row.id % SYNC_BUCKETS].append(track_dict(row))
+    return json_response(
+        {
+            "bucket_count": SYNC_BUCKETS,
+            "root": root,
+            "buckets": [
+                {
+                    "bucket": bucket,
+                    "digest": manifest.get(bucket, (0, 0))[0],
+                    "count": manifest.get(bucket, (0, 0))[1],
+                    "tracks": tracks[bucket],
+                }
+                for bucket in buckets
+            ],
+        }
     )
 
 
@@ -75,36 +280,70 @@ def patch_track_counters(
     track_id: int,
     payload: TrackCountersUpdate,
     user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    shard: int = Depends(get_library_shard),
+    db: Session = Depends(get_library_db),
 ):
-    row = (
-        db.query(LibraryTrack)
-        .filter(LibraryTrack.id == track_id, LibraryTrack.user_id == user.id)
-        .first()
+    for _ in range(3):
+        row = (
+            db.query(LibraryTrack)
+            .filter(LibraryTrack.id == track_id, LibraryTrack.user_id == user.id)
+            .first()
+        )
+        if row is None:
+            raise HTTPException(status_code=404, detail="Track not found")
+
+        row.play_count = max(0, row.play_count + payload.play_count_delta)
+        row.skip_count = max(0, row.skip_count + payload.skip_count_delta)
+        if payload.play_count_delta > 0:
+            row.last_played_at = datetime.utcnow()
+        try:
+            record_track_change(db, row, COUNTERS_CHANGED)
+            db.commit()
+            break
+        except StaleDataError:
+            # Another request bumped the version since the read: re-read and apply the deltas again.
+            db.rollback()
+    else:
+        raise HTTPException(status_code=409, detail="Track was modified concurrently, retry")
+    db.refresh(row)
+    on_track_changed(row)
+    broker.notify()
+    record_play_events(
+        shard,
+        user.id,
+        row.id,
+        plays=payload.play_count_delta,
+        skips=payload.skip_count_delta,
     )
-    if row is None:
-        raise HTTPException(status_code=404, detail="Track not found")
 
-    row.play_count = max(0, row.play_count + payload.play_count_delta)
-    row.skip_count = max(0, row.skip_count + payload.skip_count_delta)
+    return _track_out(row)
+
+
+def _insert_uploaded_track(db: Session, row: LibraryTrack) -> LibraryTrack:
+    db.add(row)
+    db.flush()
+    count_uploaded_object(db, row.user_id)
+    record_track_change(db, row, TRACK_ADDED)
     db.commit()
     db.refresh(row)
+    return row
 
-    return TrackOut(
-        id=row.id,
-        path=row.path,
-        filename=row.filename,
-        title=row.title,
-        artist=row.artist,
-        album=row.album,
-        duration_ms=row.duration_ms,
-        remote_file_key=row.remote_file_key,
-        cover_url=row.cover_url,
-        play_count=row.play_count,
-        skip_count=row.skip_count,
+
+def _get_user_track(db: Session, user: User, track_id: int) -> LibraryTrack | None:
+    return (
+        db.query(LibraryTrack)
+        .filter(LibraryTrack.id == track_id, LibraryTrack.user_id == user.id)
+        .first()
     )
 
 
+async def _storage_or_503():
+    try:
+        return await run_in_threadpool(get_storage)
+    except RuntimeError as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
+
+
 @router.post("/tracks/upload", response_model=TrackOut)
 async def upload_track_to_cloud(
     file: UploadFile = File(...),
@@ -113,20 +352,30 @@ async def upload_track_to_cloud(
     album: str | None = None,
     duration_ms: int = 0,
     user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_library_db),
 ):
-    try:
-        storage = get_storage()
-    except RuntimeError as exc:
-        raise HTTPException(status_code=503, detail=str(exc)) from exc
+    # Storage I/O is awaited and DB work runs in the threadpool: nothing here blocks the event loop.
+    storage = await _storage_or_503()
     filename = file.filename or "track.bin"
     content_type = file.content_type or "application/octet-stream"
-    file_id = storage.upload_file(
-        filename=filename,
-        stream=file.file,
-        content_type=content_type,
-        user_id=user.id,
-    )
+
+    # Size and quota are settled against the spooled upload before any byte reaches the backend.
+    size, content_hash = await run_in_threadpool(measure_stream, file.file)
+    if settings.max_upload_bytes > 0 and size > settings.max_upload_bytes:
+        raise HTTPException(status_code=413, detail="File is larger than MAX_UPLOAD_BYTES")
+    if not await run_in_threadpool(reserve_bytes, db, user.id, size):
+        raise HTTPException(status_code=413, detail="Storage quota exceeded")
+
+    try:
+        file_id = await storage.upload_file_async(
+            filename=filename,
+            stream=file.file,
+            content_type=content_type,
+            user_id=user.id,
+        )
+    except Exception:
+        await run_in_threadpool(release_reservation, db, user.id, size)
+        raise
 
     row = LibraryTrack(
         user_id=user.id,
@@ -136,50 +385,128 @@ async def upload_track_to_cloud(
         album=album,
         duration_ms=duration_ms,
         remote_file_key=file_id,
+        size_bytes=size,
+        content_hash=content_hash,
     )
-    db.add(row)
-    db.commit()
-    db.refresh(row)
+    try:
+        row = await run_in_threadpool(_insert_uploaded_track, db, row)
+    except Exception:
+        await run_in_threadpool(release_reservation, db, user.id, size)
+        await run_in_threadpool(_delete_stored_object, file_id)
+        raise
+    on_track_changed(row)
+    broker.notify()
+    if size <= settings.waveform_max_source_bytes:
+        # Peaks come from the spooled upload, so the object is not downloaded back from storage.
+        schedule_waveform(user.id, row.id, await run_in_threadpool(spool_to_temp, file.file))
 
-    return TrackOut(
-        id=row.id,
-        path=row.path,
-        filename=row.filename,
-        title=row.title,
-        artist=row.artist,
-        album=row.album,
-        duration_ms=row.duration_ms,
-        remote_file_key=row.remote_file_key,
-        cover_url=row.cover_url,
-        play_count=row.play_count,
-        skip_count=row.skip_count,
+    return _track_out(row)
+
+
+@router.get("/tracks/{track_id}/waveform")
+async def get_track_waveform(
+    track_id: int,
+    resolution: int = Query(1024, ge=1, le=65536),
+    if_none_match: str | None = Header(default=None),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    def load():
+        track = _get_user_track(db, user, track_id)
+        return track, db.get(TrackWaveform, track_id) if track is not None else None
+
+    track, waveform = await run_in_threadpool(load)
+    if track is None:
+        raise HTTPException(status_code=404, detail="Track not found")
+    if not track.remote_file_key:
+        raise HTTPException(status_code=404, detail="Track has no remote_file_key")
+    if waveform is None or is_retryable(waveform):
+        # Tracks uploaded before waveforms existed are computed on first request; failures are retried.
+        schedule_waveform(user.id, track.id)
+        return JSONResponse(status_code=202, content={"status": "pending"}, headers={"Retry-After": "5"})
+    if waveform.status == FAILED:
+        raise HTTPException(status_code=422, detail=f"Waveform unavailable: {waveform.error}")
+
+    resolutions = stored_resolutions(waveform)
+    resolution = pick_resolution(resolution, resolutions)
+    etag = waveform_etag(track.remote_file_key, resolution)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": settings.waveform_cache_control,
+        "X-Waveform-Resolution": str(resolution),
+    }
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(
+        content=slice_peaks(waveform.peaks, resolutions, resolution),
+        media_type="application/octet-stream",
+        headers=headers,
     )
 
 
 @router.get("/tracks/{track_id}/download")
-def download_track_from_cloud(
+async def download_track_from_cloud(
     track_id: int,
     user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_library_db),
 ):
-    row = (
-        db.query(LibraryTrack)
-        .filter(LibraryTrack.id == track_id, LibraryTrack.user_id == user.id)
-        .first()
-    )
+    row = await run_in_threadpool(_get_user_track, db, user, track_id)
     if row is None:
         raise HTTPException(status_code=404, detail="Track not found")
     if not row.remote_file_key:
         raise HTTPException(status_code=400, detail="Track has no remote_file_key")
 
-    try:
-        storage = get_storage()
-    except RuntimeError as exc:
-        raise HTTPException(status_code=503, detail=str(exc)) from exc
-    data = storage.download_file(row.remote_file_key)
+    storage = await _storage_or_503()
     filename = row.filename or f"track_{row.id}.bin"
+    if hasattr(storage, "local_path"):
+        # Served straight from disk (Range requests included); the ASGI server may use sendfile.
+        try:
+            path = storage.local_path(row.remote_file_key)
+        except RuntimeError as exc:
+            raise HTTPException(status_code=400, detail=str(exc)) from exc
+        if not await run_in_threadpool(os.path.isfile, path):
+            raise HTTPException(status_code=404, detail="Stored file not found")
+        return FileResponse(path, media_type="application/octet-stream", filename=filename)
+
+    data = await storage.download_file_async(row.remote_file_key)
     return Response(
         content=data,
         media_type="application/octet-stream",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
+
+
+@router.get("/tracks/{track_id}/cover")
+async def get_track_cover(
+    track_id: int,
+    size: int = Query(256, ge=1, le=4096),
+    if_none_match: str | None = Header(default=None),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    def load_cover_url():
+        return (
+            db.query(LibraryTrack.cover_url)
+            .filter(LibraryTrack.id == track_id, LibraryTrack.user_id == user.id)
+            .first()
+        )
+
+    row = await run_in_threadpool(load_cover_url)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Track not found")
+    if not row.cover_url:
+        raise HTTPException(status_code=404, detail="Track has no cover_url")
+
+    size = pick_size(size)
+    etag = cover_etag(row.cover_url, size)
+    headers = {"ETag": etag, "Cache-Control": settings.cover_cache_control}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        path = await get_cover_path(row.cover_url, size)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    except Exception as exc:
+        raise HTTPException(status_code=502, detail=f"Cover fetch failed: {exc}") from exc
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
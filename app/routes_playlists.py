@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+from datetime import datetime
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from sqlalchemy import and_, func, or_, update
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import library_session
+from app.models import LibraryTrack, Playlist, PlaylistItem, User
+from app.schemas import (
+    PlaylistCreate,
+    PlaylistItemCreate,
+    PlaylistItemMove,
+    PlaylistItemOut,
+    PlaylistItemsPage,
+    PlaylistOut,
+    PlaylistUpdate,
+)
+from app.security import get_current_user, get_library_db
+from app.serialization import TRACK_COLUMNS, json_response, track_dict
+
+router = APIRouter(prefix="/me/playlists", tags=["playlists"])
+
+
+def _playlist_out(row: Playlist) -> PlaylistOut:
+    return PlaylistOut(id=row.id, name=row.name, created_at=row.created_at, updated_at=row.updated_at)
+
+
+def _get_playlist(db: Session, user: User, playlist_id: int) -> Playlist:
+    row = db.query(Playlist).filter(Playlist.id == playlist_id, Playlist.user_id == user.id).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    return row
+
+
+def _get_item(db: Session, playlist_id: int, item_id: int) -> PlaylistItem:
+    row = (
+        db.query(PlaylistItem)
+        .filter(PlaylistItem.id == item_id, PlaylistItem.playlist_id == playlist_id)
+        .first()
+    )
+    if row is None:
+        raise HTTPException(status_code=404, detail="Playlist item not found")
+    return row
+
+
+def _neighbour(db: Session, playlist_id: int, item: PlaylistItem, after: bool, exclude_id: int | None):
+    # Items are ordered by (rank, id), so ties on rank still have a stable neighbour.
+    query = db.query(PlaylistItem.rank).filter(PlaylistItem.playlist_id == playlist_id)
+    if exclude_id is not None:
+        query = query.filter(PlaylistItem.id != exclude_id)
+    if after:
+        query = query.filter(
+            or_(PlaylistItem.rank > item.rank, and_(PlaylistItem.rank == item.rank, PlaylistItem.id > item.id))
+        ).order_by(PlaylistItem.rank.asc(), PlaylistItem.id.asc())
+    else:
+        query = query.filter(
+            or_(PlaylistItem.rank < item.rank, and_(PlaylistItem.rank == item.rank, PlaylistItem.id < item.id))
+        ).order_by(PlaylistItem.rank.desc(), PlaylistItem.id.desc())
+    found = query.first()
+    return found.rank if found else None
+
+
+def _rank_bounds(
+    db: Session,
+    playlist_id: int,
+    after_item_id: int | None,
+    before_item_id: int | None,
+    exclude_id: int | None = None,
+) -> tuple[float | None, float | None]:
+    if after_item_id is not None:
+        anchor = _get_item(db, playlist_id, after_item_id)
+        return anchor.rank, _neighbour(db, playlist_id, anchor, after=True, exclude_id=exclude_id)
+    if before_item_id is not None:
+        anchor = _get_item(db, playlist_id, before_item_id)
+        return _neighbour(db, playlist_id, anchor, after=False, exclude_id=exclude_id), anchor.rank
+
+    query = db.query(func.max(PlaylistItem.rank)).filter(PlaylistItem.playlist_id == playlist_id)
+    if exclude_id is not None:
+        query = query.filter(PlaylistItem.id != exclude_id)
+    return query.scalar(), None
+
+
+def _rank_between(low: float | None, high: float | None) -> float:
+    step = settings.playlist_rank_step
+    if low is None and high is None:
+        return step
+    if high is None:
+        return low + step
+    if low is None:
+        return high - step
+    return (low + high) / 2
+
+
+def _lock_playlist(db: Session, playlist_id: int):
+    # Serialises everything that reads and rewrites one playlist's ranks until the transaction ends:
+    # a row lock on Postgres, the database write lock on SQLite. Clients see the change in updated_at.
+    db.execute(update(Playlist).where(Playlist.id == playlist_id).values(updated_at=datetime.utcnow()))
+
+
+def _rebalance(db: Session, playlist_id: int):
+    item_ids = [
+        row.id
+        for row in db.query(PlaylistItem.id)
+        .filter(PlaylistItem.playlist_id == playlist_id)
+        .order_by(PlaylistItem.rank.asc(), PlaylistItem.id.asc())
+    ]
+    step = settings.playlist_rank_step
+    db.execute(
+        update(PlaylistItem),
+        [{"id": item_id, "rank": (i + 1) * step} for i, item_id in enumerate(item_ids)],
+    )
+
+
+def rebalance_playlist(user_id: int, playlist_id: int):
+    db = library_session(user_id)
+    try:
+        _lock_playlist(db, playlist_id)
+        _rebalance(db, playlist_id)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _place(
+    db: Session,
+    background_tasks: BackgroundTasks,
+    user_id: int,
+    playlist_id: int,
+    after_item_id: int | None,
+    before_item_id: int | None,
+    exclude_id: int | None = None,
+) -> float:
+    if after_item_id is not None and before_item_id is not None:
+        raise HTTPException(status_code=400, detail="Pass either after_item_id or before_item_id")
+    low, high = _rank_bounds(db, playlist_id, after_item_id, before_item_id, exclude_id)
+    rank = _rank_between(low, high)
+    if low is not None and high is not None:
+        if not low < rank < high:
+            # Out of float precision between these neighbours: renumber now and retry once. Runs in
+            # the request's transaction, which already holds the playlist lock.
+            _rebalance(db, playlist_id)
+            db.expire_all()
+            low, high = _rank_bounds(db, playlist_id, after_item_id, before_item_id, exclude_id)
+            rank = _rank_between(low, high)
+        elif high - low < settings.playlist_rank_min_gap:
+            background_tasks.add_task(rebalance_playlist, user_id, playlist_id)
+    return rank
+
+
+def _item_dict(item_id: int, rank: float, track) -> dict:
+    return {"item_id": item_id, "rank": rank, "track": track_dict(track)}
+
+
+@router.get("", response_model=list[PlaylistOut])
+def list_playlists(user: User = Depends(get_current_user), db: Session = Depends(get_library_db)):
+    rows = db.query(Playlist).filter(Playlist.user_id == user.id).order_by(Playlist.id.asc()).all()
+    return [_playlist_out(row) for row in rows]
+
+
+@router.post("", response_model=PlaylistOut)
+def create_playlist(payload: PlaylistCreate, user: User = Depends(get_current_user), db: Session = Depends(get_library_db)):
+    row = Playlist(user_id=user.id, name=payload.name)
+    db.add(row)
+    db.commit()
+    db.refresh(row)
+    return _playlist_out(row)
+
+
+@router.patch("/{playlist_id}", response_model=PlaylistOut)
+def rename_playlist(
+    playlist_id: int,
+    payload: PlaylistUpdate,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    row = _get_playlist(db, user, playlist_id)
+    row.name = payload.name
+    row.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(row)
+    return _playlist_out(row)
+
+
+@router.delete("/{playlist_id}")
+def delete_playlist(playlist_id: int, user: User = Depends(get_current_user), db: Session = Depends(get_library_db)):
+    row = _get_playlist(db, user, playlist_id)
+    db.delete(row)
+    db.commit()
+    return {"ok": True}
+
+
+@router.get("/{playlist_id}/items", response_model=PlaylistItemsPage)
+def get_playlist_items(
+    playlist_id: int,
+    after_rank: float | None = None,
+    after_id: int | None = None,
+    limit: int = Query(200, ge=1, le=1000),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    _get_playlist(db, user, playlist_id)
+    query = (
+        db.query(PlaylistItem.id.label("item_id"), PlaylistItem.rank, *TRACK_COLUMNS)
+        .join(LibraryTrack, LibraryTrack.id == PlaylistItem.track_id)
+        .filter(PlaylistItem.playlist_id == playlist_id)
+    )
+    if after_rank is not None:
+        query = query.filter(
+            or_(
+                PlaylistItem.rank > after_rank,
+                and_(PlaylistItem.rank == after_rank, PlaylistItem.id > (after_id or 0)),
+            )
+        )
+    rows = query.order_by(PlaylistItem.rank.asc(), PlaylistItem.id.asc()).limit(limit).all()
+
+    page = {"items": [_item_dict(row.item_id, row.rank, row) for row in rows]}
+    if len(rows) == limit:
+        page["next_after_rank"] = rows[-1].rank
+        page["next_after_id"] = rows[-1].item_id
+    return json_response(page)
+
+
+@router.post("/{playlist_id}/items", response_model=PlaylistItemOut)
+def add_playlist_item(
+    playlist_id: int,
+    payload: PlaylistItemCreate,
+    background_tasks: BackgroundTasks,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    _get_playlist(db, user, playlist_id)
+    _lock_playlist(db, playlist_id)
+    track = (
+        db.query(LibraryTrack)
+        .filter(LibraryTrack.id == payload.track_id, LibraryTrack.user_id == user.id)
+        .first()
+    )
+    if track is None:
+        raise HTTPException(status_code=404, detail="Track not found")
+
+    rank = _place(db, background_tasks, user.id, playlist_id, payload.after_item_id, payload.before_item_id)
+    row = PlaylistItem(playlist_id=playlist_id, track_id=track.id, rank=rank)
+    db.add(row)
+    db.commit()
+    return json_response(_item_dict(row.id, row.rank, track))
+
+
+@router.patch("/{playlist_id}/items/{item_id}", response_model=PlaylistItemOut)
+def move_playlist_item(
+    playlist_id: int,
+    item_id: int,
+    payload: PlaylistItemMove,
+    background_tasks: BackgroundTasks,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    _get_playlist(db, user, playlist_id)
+    _lock_playlist(db, playlist_id)
+    row = _get_item(db, playlist_id, item_id)
+    if item_id in (payload.after_item_id, payload.before_item_id):
+        raise HTTPException(status_code=400, detail="Cannot move an item relative to itself")
+    row.rank = _place(
+        db,
+        background_tasks,
+        user.id,
+        playlist_id,
+        payload.after_item_id,
+        payload.before_item_id,
+        exclude_id=row.id,
+    )
+    db.commit()
+    track = db.get(LibraryTrack, row.track_id)
+    return json_response(_item_dict(row.id, row.rank, track))
+
+
+@router.delete("/{playlist_id}/items/{item_id}")
+def delete_playlist_item(
+    playlist_id: int,
+    item_id: int,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    _get_playlist(db, user, playlist_id)
+    _lock_playlist(db, playlist_id)
+    row = _get_item(db, playlist_id, item_id)
+    db.delete(row)
+    db.commit()
+    return {"ok": True}
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import func, union_all
+from sqlalchemy.orm import Session
+
+from app.models import LibraryTrack, PlayRollupDaily, PlayRollupWeekly, User
+from app.play_events import week_start
+from app.schemas import TopAlbumOut, TopArtistOut, TopTrackOut
+from app.security import get_current_user, get_library_db
+
+router = APIRouter(prefix="/me/stats", tags=["stats"])
+
+
+def _window_rollups(db: Session, user_id: int, days: int):
+    # Whole weeks inside the window come from weekly rollups, ragged edges from daily ones.
+    today = datetime.utcnow().date()
+    start = today - timedelta(days=days - 1)
+    first_full_week = start if start.weekday() == 0 else week_start(start) + timedelta(days=7)
+    last_full_week = week_start(today) if today.weekday() == 6 else week_start(today) - timedelta(days=7)
+
+    daily = db.query(PlayRollupDaily.track_id, PlayRollupDaily.plays, PlayRollupDaily.skips).filter(
+        PlayRollupDaily.user_id == user_id,
+        PlayRollupDaily.day >= start,
+        PlayRollupDaily.day <= today,
+    )
+    if first_full_week > last_full_week:
+        return daily.subquery()
+
+    daily = daily.filter(
+        (PlayRollupDaily.day < first_full_week)
+        | (PlayRollupDaily.day > last_full_week + timedelta(days=6))
+    )
+    weekly = db.query(PlayRollupWeekly.track_id, PlayRollupWeekly.plays, PlayRollupWeekly.skips).filter(
+        PlayRollupWeekly.user_id == user_id,
+        PlayRollupWeekly.week_start >= first_full_week,
+        PlayRollupWeekly.week_start <= last_full_week,
+    )
+    return union_all(daily.statement, weekly.statement).subquery()
+
+
+def _ranked(db: Session, user_id: int, days: int, *group_cols):
+    window = _window_rollups(db, user_id, days)
+    plays = func.sum(window.c.plays).label("plays")
+    skips = func.sum(window.c.skips).label("skips")
+    return (
+        db.query(*group_cols, plays, skips)
+        .join(window, window.c.track_id == LibraryTrack.id)
+        .filter(LibraryTrack.user_id == user_id)
+        .group_by(*group_cols)
+        .order_by(plays.desc(), skips.asc())
+    )
+
+
+@router.get("/top/tracks", response_model=list[TopTrackOut])
+def top_tracks(
+    days: int = Query(7, ge=1, le=366),
+    limit: int = Query(20, ge=1, le=200),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    rows = _ranked(
+        db, user.id, days, LibraryTrack.id, LibraryTrack.title, LibraryTrack.artist, LibraryTrack.album
+    ).limit(limit)
+    return [
+        TopTrackOut(
+            track_id=row.id,
+            title=row.title,
+            artist=row.artist,
+            album=row.album,
+            plays=row.plays or 0,
+            skips=row.skips or 0,
+        )
+        for row in rows
+    ]
+
+
+@router.get("/top/artists", response_model=list[TopArtistOut])
+def top_artists(
+    days: int = Query(7, ge=1, le=366),
+    limit: int = Query(20, ge=1, le=200),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    rows = _ranked(db, user.id, days, LibraryTrack.artist).limit(limit)
+    return [TopArtistOut(artist=row.artist, plays=row.plays or 0, skips=row.skips or 0) for row in rows]
+
+
+@router.get("/top/albums", response_model=list[TopAlbumOut])
+def top_albums(
+    days: int = Query(7, ge=1, le=366),
+    limit: int = Query(20, ge=1, le=200),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_library_db),
+):
+    rows = _ranked(db, user.id, days, LibraryTrack.album, LibraryTrack.artist).limit(limit)
+    return [
+        TopAlbumOut(album=row.album, artist=row.artist, plays=row.plays or 0, skips=row.skips or 0)
+        for row in rows
+    ]
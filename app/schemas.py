@@ -1,6 +1,8 @@
 ﻿from __future__ import annotations
 
-from pydantic import BaseModel
+from datetime import datetime
+
+from pydantic import BaseModel, Field, field_validator
 
 
 class TelegramLoginPayload(BaseModel):
@@ -83,8 +85,130 @@ class TrackOut(BaseModel):
     cover_url: str | None
     play_count: int
     skip_count: int
+    size_bytes: int = 0
+    content_hash: str | None = None
+    version: int = 1
 
 
 class TrackCountersUpdate(BaseModel):
-    play_count_delta: int = 0
-    skip_count_delta: int = 0
+    # Each play becomes one buffered event row, so a single request cannot ask for millions.
+    play_count_delta: int = Field(0, ge=-1000, le=1000)
+    skip_count_delta: int = Field(0, ge=-1000, le=1000)
+
+
+class TrackUpdate(BaseModel):
+    path: str | None = None
+    filename: str | None = None
+    title: str | None = None
+    artist: str | None = None
+    album: str | None = None
+    duration_ms: int | None = None
+    cover_url: str | None = None
+
+    @field_validator("duration_ms")
+    @classmethod
+    def _not_null(cls, value):
+        # Omit the field to leave it unchanged; the column itself is NOT NULL.
+        if value is None:
+            raise ValueError("must not be null")
+        return value
+
+
+class TopTrackOut(BaseModel):
+    track_id: int
+    title: str | None
+    artist: str | None
+    album: str | None
+    plays: int
+    skips: int
+
+
+class TopArtistOut(BaseModel):
+    artist: str | None
+    plays: int
+    skips: int
+
+
+class TopAlbumOut(BaseModel):
+    album: str | None
+    artist: str | None
+    plays: int
+    skips: int
+
+
+class PlaylistCreate(BaseModel):
+    name: str
+
+
+class PlaylistUpdate(BaseModel):
+    name: str
+
+
+class PlaylistOut(BaseModel):
+    id: int
+    name: str
+    created_at: datetime
+    updated_at: datetime
+
+
+class PlaylistItemCreate(BaseModel):
+    track_id: int
+    after_item_id: int | None = None
+    before_item_id: int | None = None
+
+
+class PlaylistItemMove(BaseModel):
+    after_item_id: int | None = None
+    before_item_id: int | None = None
+
+
+class PlaylistItemOut(BaseModel):
+    item_id: int
+    rank: float
+    track: TrackOut
+
+
+class PlaylistItemsPage(BaseModel):
+    items: list[PlaylistItemOut]
+    next_after_rank: float | None = None
+    next_after_id: int | None = None
+
+
+class StorageUsageOut(BaseModel):
+    bytes_used: int
+    object_count: int
+    quota_bytes: int
+    max_upload_bytes: int
+
+
+class LibrarySyncRequest(BaseModel):
+    # bucket -> digest of the client's copy; omitted buckets are empty on the device.
+    buckets: dict[int, int] = {}
+    root: int | None = None
+
+
+class LibrarySyncBucketOut(BaseModel):
+    bucket: int
+    digest: int
+    count: int
+    tracks: list[TrackOut]
+
+
+class LibrarySyncResponse(BaseModel):
+    bucket_count: int
+    root: int
+    buckets: list[LibrarySyncBucketOut]
+
+
+class LibraryChangeOut(BaseModel):
+    id: int
+    kind: str
+    track_id: int | None
+    data: dict | None
+    ts: str | None
+
+
+class LibraryChangesPage(BaseModel):
+    changes: list[LibraryChangeOut]
+    last_id: int
+    reset: bool = False
@@ -8,7 +8,7 @@ from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from sqlalchemy.orm import Session
 
 from app.config import settings
-from app.database import get_db
+from app.database import ShardUnavailable, get_db, mirror_user, shard_for_user, shard_sessions
 from app.models import User
 
 security = HTTPBearer(auto_error=False)
@@ -44,4 +44,31 @@ def get_current_user(
     user = db.get(User, int(sub))
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return user
+    return user
+
+
+def get_admin_user(user: User = Depends(get_current_user)) -> User:
+    if not user.is_admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return user
+
+
+def get_library_shard(user: User = Depends(get_current_user)) -> int:
+    try:
+        return shard_for_user(user.id)
+    except ShardUnavailable as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(exc),
+            headers={"Retry-After": str(settings.shard_move_retry_after_seconds)},
+        ) from exc
+
+
+def get_library_db(user: User = Depends(get_current_user), shard: int = Depends(get_library_shard)):
+    # Session on the shard that holds this user's library; FastAPI reuses the lookups above.
+    mirror_user(shard, user.id)
+    db = shard_sessions[shard]()
+    try:
+        yield db
+    finally:
+        db.close()
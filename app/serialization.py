@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from fastapi.responses import Response
+from pydantic_core import to_json
+
+from app.models import LibraryTrack
+
+# Column set matching TrackOut; selecting plain columns skips ORM identity-map bookkeeping.
+TRACK_COLUMNS = (
+    LibraryTrack.id,
+    LibraryTrack.path,
+    LibraryTrack.filename,
+    LibraryTrack.title,
+    LibraryTrack.artist,
+    LibraryTrack.album,
+    LibraryTrack.duration_ms,
+    LibraryTrack.remote_file_key,
+    LibraryTrack.cover_url,
+    LibraryTrack.play_count,
+    LibraryTrack.skip_count,
+    LibraryTrack.size_bytes,
+    LibraryTrack.content_hash,
+    LibraryTrack.version,
+)
+
+
+def track_dict(row) -> dict:
+    return {column.key: getattr(row, column.key) for column in TRACK_COLUMNS}
+
+
+def json_response(payload) -> Response:
+    # Serialised in pydantic-core directly instead of re-validating against response_model.
+    return Response(content=to_json(payload), media_type="application/json")
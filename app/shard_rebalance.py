@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import delete, false, func, insert, select, text, update
+from sqlalchemy.orm import Session
+
+from app.change_feed import RESET, latest_change_id
+from app.config import settings
+from app.database import SHARD_ACTIVE, SHARD_MOVING, SessionLocal, forget_shard, lookup_shard, mirror_user, shard_sessions
+from app.library_sync import rebuild_sync_buckets
+from app.models import (
+    LibraryChange,
+    LibrarySyncBucket,
+    LibraryTrack,
+    PlayEvent,
+    Playlist,
+    PlaylistItem,
+    PlayRollupDaily,
+    PlayRollupWeekly,
+    TrackWaveform,
+    UserShard,
+    UserStorageUsage,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryChanged(RuntimeError):
+    pass
+
+
+def set_directory(user_id: int, shard: int, state: str):
+    db = SessionLocal()
+    try:
+        row = db.get(UserShard, user_id)
+        if row is None:
+            row = UserShard(user_id=user_id)
+            db.add(row)
+        row.shard = shard
+        row.state = state
+        row.updated_at = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+    forget_shard(user_id)
+
+
+def _user_tracks(user_id: int):
+    return select(LibraryTrack.id).where(LibraryTrack.user_id == user_id)
+
+
+def _user_playlists(user_id: int):
+    return select(Playlist.id).where(Playlist.user_id == user_id)
+
+
+def delete_user_rows(db: Session, user_id: int):
+    db.execute(delete(PlaylistItem).where(PlaylistItem.playlist_id.in_(_user_playlists(user_id))))
+    db.execute(delete(Playlist).where(Playlist.user_id == user_id))
+    db.execute(delete(TrackWaveform).where(TrackWaveform.track_id.in_(_user_tracks(user_id))))
+    for model in (PlayEvent, PlayRollupDaily, PlayRollupWeekly, LibrarySyncBucket, UserStorageUsage, LibraryChange):
+        db.execute(delete(model).where(model.user_id == user_id))
+    db.execute(delete(LibraryTrack).where(LibraryTrack.user_id == user_id))
+
+
+def _fingerprint(db: Session, user_id: int) -> tuple:
+    # Every write a library request can make moves one of these numbers.
+    tracks = db.execute(
+        select(func.count(LibraryTrack.id), func.max(LibraryTrack.id), func.sum(LibraryTrack.version)).where(
+            LibraryTrack.user_id == user_id
+        )
+    ).one()
+    playlists = db.execute(
+        select(func.count(Playlist.id), func.max(Playlist.id), func.max(Playlist.updated_at)).where(
+            Playlist.user_id == user_id
+        )
+    ).one()
+    items = db.execute(
+        select(func.count(PlaylistItem.id), func.max(PlaylistItem.id), func.sum(PlaylistItem.rank)).where(
+            PlaylistItem.playlist_id.in_(_user_playlists(user_id))
+        )
+    ).one()
+    events = db.execute(
+        select(func.count(PlayEvent.id), func.max(PlayEvent.id)).where(PlayEvent.user_id == user_id)
+    ).one()
+    usage = db.execute(
+        select(UserStorageUsage.bytes_used, UserStorageUsage.object_count).where(UserStorageUsage.user_id == user_id)
+    ).first()
+    return tuple(tracks) + tuple(playlists) + tuple(items) + tuple(events) + (tuple(usage) if usage else ())
+
+
+def _block_writes(db: Session):
+    # Held until this transaction ends, so no write can land between the final check and the delete.
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(
+            text(
+                "LOCK TABLE library_tracks, playlists, playlist_items, play_events, user_storage_usage "
+                "IN EXCLUSIVE MODE"
+            )
+        )
+    else:
+        # SQLite: any write statement takes the database write lock for the rest of the transaction.
+        db.execute(update(LibraryTrack).where(false()).values(version=LibraryTrack.version))
+
+
+def _remap(row: dict, remap: dict[str, dict[int, int]]) -> dict | None:
+    for column, ids in remap.items():
+        if row[column] not in ids:
+            # Points at a track that no longer exists (play events carry no FK).
+            return None
+        row[column] = ids[row[column]]
+    return row
+
+
+def _copy_renumbered(
+    src: Session,
+    dst: Session,
+    model,
+    where,
+    batch_size: int,
+    remap: dict[str, dict[int, int]] | None = None,
+) -> dict[int, int]:
+    # Ids are per shard, so rows get fresh ids on the target; returns old id -> new id.
+    table = model.__table__
+    ids: dict[int, int] = {}
+    last_id = 0
+    while True:
+        rows = src.execute(
+            select(table).where(where, table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+        ).mappings().all()
+        if not rows:
+            return ids
+        last_id = rows[-1]["id"]
+        old_ids, values = [], []
+        for row in rows:
+            value = _remap({key: row[key] for key in row.keys() if key != "id"}, remap or {})
+            if value is not None:
+                old_ids.append(row["id"])
+                values.append(value)
+        if values:
+            new_ids = dst.execute(
+                insert(table).returning(table.c.id, sort_by_parameter_order=True), values
+            ).scalars().all()
+            ids.update(zip(old_ids, new_ids))
+
+
+def _copy_rows(src: Session, dst: Session, model, where, batch_size: int, remap: dict[str, dict[int, int]]) -> int:
+    table = model.__table__
+    copied = 0
+    batch: list[dict] = []
+    result = src.execute(select(table).where(where), execution_options={"yield_per": batch_size})
+    for row in result.mappings():
+        value = _remap(dict(row), remap)
+        if value is not None:
+            batch.append(value)
+        if len(batch) >= batch_size:
+            dst.execute(insert(table), batch)
+            copied += len(batch)
+            batch = []
+    if batch:
+        dst.execute(insert(table), batch)
+        copied += len(batch)
+    return copied
+
+
+def _append_reset(src: Session, dst: Session, user_id: int):
+    # Above every id the user's clients can hold from the old shard, so their next replay starts with it.
+    change_id = max(latest_change_id(src), latest_change_id(dst)) + 1
+    dst.execute(
+        insert(LibraryChange.__table__).values(
+            id=change_id,
+            user_id=user_id,
+            kind=RESET,
+            payload=json.dumps({"reason": "shard_move"}),
+            created_at=datetime.utcnow(),
+        )
+    )
+    if dst.get_bind().dialect.name == "postgresql":
+        dst.execute(text("SELECT setval(pg_get_serial_sequence('library_changes', 'id'), :id)"), {"id": change_id})
+
+
+def _copy_library(src: Session, dst: Session, user_id: int, batch_size: int) -> dict[str, int]:
+    tracks = _copy_renumbered(src, dst, LibraryTrack, LibraryTrack.user_id == user_id, batch_size)
+    playlists = _copy_renumbered(src, dst, Playlist, Playlist.user_id == user_id, batch_size)
+    items = _copy_renumbered(
+        src,
+        dst,
+        PlaylistItem,
+        PlaylistItem.playlist_id.in_(_user_playlists(user_id)),
+        batch_size,
+        {"playlist_id": playlists, "track_id": tracks},
+    )
+    events = _copy_renumbered(src, dst, PlayEvent, PlayEvent.user_id == user_id, batch_size, {"track_id": tracks})
+    counts = {"tracks": len(tracks), "playlists": len(playlists), "playlist_items": len(items), "play_events": len(events)}
+    for name, model, where, remap in (
+        ("rollups_daily", PlayRollupDaily, PlayRollupDaily.user_id == user_id, {"track_id": tracks}),
+        ("rollups_weekly", PlayRollupWeekly, PlayRollupWeekly.user_id == user_id, {"track_id": tracks}),
+        ("waveforms", TrackWaveform, TrackWaveform.track_id.in_(_user_tracks(user_id)), {"track_id": tracks}),
+        ("storage_usage", UserStorageUsage, UserStorageUsage.user_id == user_id, {}),
+    ):
+        # Waveform rows hold the peaks blob, so they go over in smaller batches.
+        size = max(1, batch_size // 20) if model is TrackWaveform else batch_size
+        counts[name] = _copy_rows(src, dst, model, where, size, remap)
+    _append_reset(src, dst, user_id)
+    return counts
+
+
+def move_user(
+    user_id: int,
+    target: int,
+    grace_seconds: float | None = None,
+    batch_size: int | None = None,
+    log: Callable[[str], None] = logger.info,
+) -> dict:
+    # Online for everyone else; the moving user's library requests get 503 + Retry-After until it finishes.
+    if not 0 <= target < len(shard_sessions):
+        raise ValueError(f"Unknown shard {target}, {len(shard_sessions)} configured")
+    source, state = lookup_shard(user_id)
+    if source == target:
+        if state != SHARD_ACTIVE:
+            set_directory(user_id, source, SHARD_ACTIVE)
+        return {"user_id": user_id, "shard": source, "moved": False}
+    if grace_seconds is None:
+        # Plus one play-event flush, so events buffered by the last requests land before the snapshot.
+        grace_seconds = settings.shard_directory_ttl_seconds * 2 + settings.play_events_flush_seconds
+    batch_size = batch_size or settings.shard_move_batch_size
+
+    set_directory(user_id, source, SHARD_MOVING)
+    src = shard_sessions[source]()
+    dst = shard_sessions[target]()
+    try:
+        log(f"User {user_id}: shard {source} -> {target}, waiting {grace_seconds:g}s for in-flight requests")
+        # Every process re-reads the directory within the TTL; the rest lets requests already running finish.
+        time.sleep(grace_seconds)
+        mirror_user(target, user_id)
+        before = _fingerprint(src, user_id)
+        # Leftovers from an earlier, interrupted move.
+        delete_user_rows(dst, user_id)
+        counts = _copy_library(src, dst, user_id, batch_size)
+        dst.commit()
+        rebuild_sync_buckets(dst, user_id)
+        src.rollback()
+        # The check and the delete share one write-locked transaction on the source, and the directory
+        # stays MOVING until both are done, so a late write either aborts the move or is never accepted.
+        _block_writes(src)
+        if _fingerprint(src, user_id) != before:
+            raise LibraryChanged("Library changed while it was copied; retry with a longer grace period")
+        delete_user_rows(src, user_id)
+        src.commit()
+    except BaseException:
+        src.rollback()
+        dst.rollback()
+        try:
+            delete_user_rows(dst, user_id)
+            dst.commit()
+        except Exception:
+            logger.exception("Could not clean up partial copy of user %s on shard %s", user_id, target)
+        set_directory(user_id, source, SHARD_ACTIVE)
+        src.close()
+        dst.close()
+        raise
+
+    src.close()
+    dst.close()
+    try:
+        set_directory(user_id, target, SHARD_ACTIVE)
+    except Exception:
+        # The rows already live only on the target; re-running the move would copy an empty library.
+        logger.critical(
+            "User %s was moved to shard %s but the directory update failed; set user_shards.shard = %s, state = %s",
+            user_id,
+            target,
+            target,
+            SHARD_ACTIVE,
+        )
+        raise
+    log(f"User {user_id}: copied {counts}, now served from shard {target}")
+    return {"user_id": user_id, "shard": target, "moved": True, "copied": counts}
+
+
+def shard_report(user_id: int | None = None) -> dict:
+    db = SessionLocal()
+    try:
+        if user_id is not None:
+            row = db.get(UserShard, user_id)
+            return {
+                "user_id": user_id,
+                "shard": row.shard if row else None,
+                "state": row.state if row else None,
+                "shards": len(shard_sessions),
+            }
+        rows = db.query(UserShard.shard, UserShard.state, func.count(UserShard.user_id)).group_by(
+            UserShard.shard, UserShard.state
+        )
+        users: dict[int, dict[str, int]] = {}
+        for shard, state, count in rows:
+            users.setdefault(shard, {})[state] = count
+        return {"shards": len(shard_sessions), "users": users}
+    finally:
+        db.close()
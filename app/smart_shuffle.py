@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import random
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import shard_sessions
+from app.models import LibraryTrack, PlayEvent
+from app.warmup import register_cache_primer
+
+
+def track_weight(play_count: int, skip_count: int, last_played_at: datetime | None, now: datetime | None = None) -> float:
+    # Laplace-smoothed play ratio, squared to favour tracks the user actually finishes.
+    affinity = (play_count + 1) / (play_count + skip_count + 2)
+    freshness = 1.0
+    if last_played_at is not None:
+        hours = max(0.0, ((now or datetime.utcnow()) - last_played_at).total_seconds() / 3600)
+        freshness = 1 - 0.5 ** (hours / settings.shuffle_recency_half_life_hours)
+    return affinity * affinity * max(freshness, 0.05)
+
+
+class FenwickSampler:
+    def __init__(self, weights: list[float]):
+        self.size = len(weights)
+        self.weights = list(weights)
+        self.tree = [0.0] * (self.size + 1)
+        for i, weight in enumerate(self.weights, start=1):
+            self.tree[i] += weight
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def total(self) -> float:
+        total = 0.0
+        i = self.size
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def update(self, index: int, weight: float):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, target: float) -> int:
+        # Smallest index whose prefix sum exceeds target.
+        pos = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] <= target:
+                pos = nxt
+                target -= self.tree[nxt]
+            step >>= 1
+        return min(pos, self.size - 1)
+
+
+class ShuffleIndex:
+    def __init__(self, entries: list[tuple[int, float]]):
+        self.track_ids = [track_id for track_id, _ in entries]
+        self.positions = {track_id: i for i, track_id in enumerate(self.track_ids)}
+        self.sampler = FenwickSampler([weight for _, weight in entries])
+        self.built_at = time.monotonic()
+
+    def set_weight(self, track_id: int, weight: float):
+        pos = self.positions.get(track_id)
+        if pos is not None:
+            self.sampler.update(pos, weight)
+            return
+        # New tracks are rare next to counter updates, so growing simply rebuilds the tree.
+        self.positions[track_id] = len(self.track_ids)
+        self.track_ids.append(track_id)
+        self.sampler = FenwickSampler(self.sampler.weights + [weight])
+
+    def remove(self, track_id: int):
+        pos = self.positions.get(track_id)
+        if pos is not None:
+            self.sampler.update(pos, 0.0)
+
+    def sample(self, count: int, rng: random.Random) -> list[int]:
+        picked: list[tuple[int, float]] = []
+        try:
+            while len(picked) < count:
+                total = self.sampler.total()
+                if total <= 1e-12:
+                    break
+                pos = self.sampler.find(rng.random() * total)
+                weight = self.sampler.weights[pos]
+                if weight <= 0:
+                    break
+                picked.append((pos, weight))
+                self.sampler.update(pos, 0.0)
+        finally:
+            for pos, weight in picked:
+                self.sampler.update(pos, weight)
+        return [self.track_ids[pos] for pos, _ in picked]
+
+
+_indexes: OrderedDict[int, ShuffleIndex] = OrderedDict()
+_lock = threading.Lock()
+_rng = random.Random()
+
+
+def _build_index(db: Session, user_id: int) -> ShuffleIndex:
+    now = datetime.utcnow()
+    rows = (
+        db.query(LibraryTrack.id, LibraryTrack.play_count, LibraryTrack.skip_count, LibraryTrack.last_played_at)
+        .filter(LibraryTrack.user_id == user_id)
+        .all()
+    )
+    return ShuffleIndex(
+        [(row.id, track_weight(row.play_count or 0, row.skip_count or 0, row.last_played_at, now)) for row in rows]
+    )
+
+
+def sample_tracks(db: Session, user_id: int, count: int) -> list[int]:
+    with _lock:
+        index = _indexes.get(user_id)
+        if index is not None and time.monotonic() - index.built_at < settings.shuffle_index_ttl_seconds:
+            _indexes.move_to_end(user_id)
+            return index.sample(count, _rng)
+
+    # Recency decays with wall-clock time, so indexes are rebuilt after the TTL.
+    index = _build_index(db, user_id)
+    with _lock:
+        _indexes[user_id] = index
+        _indexes.move_to_end(user_id)
+        while len(_indexes) > settings.shuffle_index_max_users:
+            _indexes.popitem(last=False)
+        return index.sample(count, _rng)
+
+
+def on_track_changed(row: LibraryTrack):
+    with _lock:
+        index = _indexes.get(row.user_id)
+        if index is not None:
+            index.set_weight(row.id, track_weight(row.play_count or 0, row.skip_count or 0, row.last_played_at))
+
+
+def on_track_removed(user_id: int, track_id: int):
+    with _lock:
+        index = _indexes.get(user_id)
+        if index is not None:
+            index.remove(track_id)
+
+
+def prime_indexes():
+    # Build indexes up front for the users who played something most recently.
+    limit = min(settings.warmup_shuffle_users, settings.shuffle_index_max_users)
+    if limit <= 0:
+        return
+    recent: list[tuple[datetime, int, int]] = []
+    for shard, make_session in enumerate(shard_sessions):
+        db = make_session()
+        try:
+            last_played = func.max(PlayEvent.ts)
+            rows = db.execute(
+                select(PlayEvent.user_id, last_played)
+                .group_by(PlayEvent.user_id)
+                .order_by(last_played.desc())
+                .limit(limit)
+            ).all()
+        finally:
+            db.close()
+        recent.extend((ts, shard, user_id) for user_id, ts in rows)
+
+    recent.sort(reverse=True)
+    for _, shard, user_id in reversed(recent[:limit]):
+        db = shard_sessions[shard]()
+        try:
+            index = _build_index(db, user_id)
+        finally:
+            db.close()
+        with _lock:
+            _indexes[user_id] = index
+            _indexes.move_to_end(user_id)
+            while len(_indexes) > settings.shuffle_index_max_users:
+                _indexes.popitem(last=False)
+
+
+register_cache_primer("shuffle_index", prime_indexes)
@@ -1,10 +1,15 @@
 from __future__ import annotations
 
+import threading
+
 from app.config import settings
 
+_storage = None
+_storage_lock = threading.Lock()
 
-def get_storage():
-    provider = (settings.storage_provider or "").lower()
+
+def build_storage(provider: str):
+    provider = (provider or "").lower()
     if provider == "supabase":
         from app.storage_supabase import SupabaseStorage
 
@@ -13,4 +18,30 @@ def get_storage():
         from app.storage_google_drive import GoogleDriveStorage
 
         return GoogleDriveStorage()
-    raise RuntimeError("Unknown STORAGE_PROVIDER. Supported: supabase, gdrive")
+    if provider == "local":
+        from app.storage_local import LocalStorage
+
+        return LocalStorage()
+    if provider == "replicated":
+        from app.storage_replicated import ReplicatedStorage
+
+        return ReplicatedStorage(settings.storage_primary, settings.storage_secondary)
+    raise RuntimeError("Unknown STORAGE_PROVIDER. Supported: supabase, gdrive, local, replicated")
+
+
+async def close_storage():
+    # Called on shutdown so async HTTP clients release their connections.
+    global _storage
+    storage, _storage = _storage, None
+    if storage is not None:
+        await storage.aclose()
+
+
+def get_storage():
+    # Clients hold HTTP sessions / API discovery docs, so build once per process.
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = build_storage(settings.storage_provider)
+    return _storage
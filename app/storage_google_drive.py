@@ -1,16 +1,112 @@
 from __future__ import annotations
 
 import io
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from typing import BinaryIO
+from uuid import uuid4
 
+import httplib2
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 
 from app.config import settings
+from app.storage_io import BlockingStorageMixin
 
+logger = logging.getLogger(__name__)
 
-class GoogleDriveStorage:
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# Drive rejects batches with more than 100 calls.
+MAX_BATCH_SIZE = 100
+
+
+class _DriveBatcher:
+    # Coalesces metadata calls (folder lookups/creates, deletes) issued by concurrent threads into one
+    # batch HTTP request. Media uploads cannot be batched and never go through here.
+
+    def __init__(self, service, http_factory, window_seconds: float, timeout_seconds: float):
+        self.service = service
+        self._http_factory = http_factory
+        self.window = window_seconds
+        self.timeout = timeout_seconds
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def call(self, request):
+        future: Future = Future()
+        self._queue.put((request, future))
+        self._ensure_thread()
+        # Raises TimeoutError rather than hanging the request if the batch thread is stuck.
+        return future.result(timeout=self.timeout)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="gdrive-batch", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        http = None
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(pending) < MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                if http is None:
+                    http = self._http_factory()
+                self._execute(pending, http)
+            except Exception as exc:
+                # Fail this batch's callers, not the thread every later call depends on.
+                logger.exception("Google Drive batch of %s calls failed", len(pending))
+                http = None
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(exc)
+
+    def _execute(self, pending: list[tuple], http):
+        if len(pending) == 1:
+            request, future = pending[0]
+            try:
+                future.set_result(request.execute(http=http))
+            except Exception as exc:
+                future.set_exception(exc)
+            return
+
+        def on_response(request_id, response, exception):
+            future = pending[int(request_id)][1]
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(response)
+
+        batch = self.service.new_batch_http_request(callback=on_response)
+        for index, (request, _) in enumerate(pending):
+            batch.add(request, request_id=str(index))
+        try:
+            batch.execute(http=http)
+        except Exception as exc:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(exc)
+
+
+class GoogleDriveStorage(BlockingStorageMixin):
     def __init__(self):
         if not settings.google_drive_enabled:
             raise RuntimeError("Google Drive storage is disabled")
@@ -19,12 +115,103 @@ class GoogleDriveStorage:
         if not settings.google_drive_folder_id:
             raise RuntimeError("GOOGLE_DRIVE_FOLDER_ID is empty")
 
-        creds = service_account.Credentials.from_service_account_file(
+        self.creds = service_account.Credentials.from_service_account_file(
             settings.google_drive_service_account_json,
             scopes=["https://www.googleapis.com/auth/drive"],
         )
-        self.service = build("drive", "v3", credentials=creds, cache_discovery=False)
+        self.service = build("drive", "v3", credentials=self.creds, cache_discovery=False)
         self.folder_id = settings.google_drive_folder_id
+        self._local = threading.local()
+        # Folder path ("user_7/3f") -> Drive id. Folders are never removed, so entries never go stale.
+        self._folder_ids: dict[str, str] = {"": self.folder_id}
+        self._folder_locks: dict[str, threading.Lock] = {}
+        self._folder_locks_guard = threading.Lock()
+        self._batcher = _DriveBatcher(
+            self.service,
+            lambda: AuthorizedHttp(self.creds, http=httplib2.Http(timeout=settings.google_drive_timeout_seconds)),
+            settings.google_drive_batch_window_ms / 1000,
+            settings.google_drive_timeout_seconds,
+        )
+
+    def _http(self) -> AuthorizedHttp:
+        # httplib2 connections are not thread-safe; the instance is shared, so keep one per thread.
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._local.http = http
+        return http
+
+    def _folder_lock(self, path: str) -> threading.Lock:
+        with self._folder_locks_guard:
+            return self._folder_locks.setdefault(path, threading.Lock())
+
+    def _list_folders(self, query: str, page_size: int) -> list[dict]:
+        # Oldest first, so every worker settles on the same folder when a name exists twice.
+        found = self._batcher.call(
+            self.service.files().list(
+                q=f"{query} and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false",
+                fields="files(id,name,createdTime)",
+                pageSize=page_size,
+                spaces="drive",
+            )
+        )
+        return sorted(found.get("files", []), key=lambda folder: (folder.get("createdTime", ""), folder["id"]))
+
+    def _child_folder(self, parent_id: str, name: str) -> str:
+        query = f"name = '{name}' and '{parent_id}' in parents"
+        existing = self._list_folders(query, 10)
+        if existing:
+            return existing[0]["id"]
+        created = self._batcher.call(
+            self.service.files().create(
+                body={"name": name, "mimeType": FOLDER_MIME_TYPE, "parents": [parent_id]},
+                fields="id",
+            )
+        )["id"]
+        # The per-path lock only covers this process; another worker may have created the same folder.
+        winner = (self._list_folders(query, 10) or [{"id": created}])[0]["id"]
+        if winner != created:
+            self._discard_folder(created)
+        return winner
+
+    def _discard_folder(self, folder_id: str):
+        # Deleting a folder deletes its contents too, so only drop a duplicate nobody has written into.
+        try:
+            children = self._batcher.call(
+                self.service.files().list(
+                    q=f"'{folder_id}' in parents and trashed = false", fields="files(id)", pageSize=1, spaces="drive"
+                )
+            )
+            if not children.get("files"):
+                self._batcher.call(self.service.files().delete(fileId=folder_id))
+        except Exception:
+            logger.warning("Could not remove duplicate Drive folder %s", folder_id, exc_info=True)
+
+    def _prefetch_children(self, path: str, folder_id: str):
+        # One listing caches every existing shard of a user instead of a lookup per shard later.
+        for child in self._list_folders(f"'{folder_id}' in parents", 1000):
+            self._folder_ids.setdefault(f"{path}/{child['name']}", child["id"])
+
+    def _ensure_folder(self, path: str) -> str:
+        folder_id = self._folder_ids.get(path)
+        if folder_id is not None:
+            return folder_id
+        parent_path, _, name = path.rpartition("/")
+        parent_id = self._ensure_folder(parent_path)
+        # Lookup-then-create is serialised per path within this process; _child_folder handles other workers.
+        with self._folder_lock(path):
+            folder_id = self._folder_ids.get(path)
+            if folder_id is None:
+                folder_id = self._child_folder(parent_id, name)
+                if not parent_path:
+                    self._prefetch_children(path, folder_id)
+                self._folder_ids[path] = folder_id
+        return folder_id
+
+    def _shard_path(self, user_id: int | None) -> str:
+        # Uniform two-hex-digit shard: at most 256 subfolders per user, each a small fraction of the files.
+        prefix = f"user_{user_id}" if user_id else "shared"
+        return f"{prefix}/{uuid4().hex[:2]}"
 
     def upload_file(
         self,
@@ -33,17 +220,19 @@ class GoogleDriveStorage:
         content_type: str = "application/octet-stream",
         user_id: int | None = None,
     ) -> str:
-        metadata = {"name": filename, "parents": [self.folder_id]}
+        parent_id = self._ensure_folder(self._shard_path(user_id))
+        metadata = {"name": filename, "parents": [parent_id]}
         media = MediaIoBaseUpload(stream, mimetype=content_type, resumable=False)
         created = (
             self.service.files()
             .create(body=metadata, media_body=media, fields="id")
-            .execute()
+            .execute(http=self._http())
         )
         return created["id"]
 
     def download_file(self, file_id: str) -> bytes:
         request = self.service.files().get_media(fileId=file_id)
+        request.http = self._http()
         output = io.BytesIO()
         downloader = MediaIoBaseDownload(output, request)
         done = False
@@ -52,6 +241,17 @@ class GoogleDriveStorage:
         output.seek(0)
         return output.read()
 
+    def delete_file(self, file_id: str) -> None:
+        try:
+            self._batcher.call(self.service.files().delete(fileId=file_id))
+        except HttpError as exc:
+            if exc.resp.status != 404:
+                raise
+
+    def ping(self, timeout: float = 5) -> None:
+        http = AuthorizedHttp(self.creds, http=httplib2.Http(timeout=timeout))
+        self.service.files().get(fileId=self.folder_id, fields="id").execute(http=http)
+
 
 def get_storage() -> GoogleDriveStorage:
     return GoogleDriveStorage()
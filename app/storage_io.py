@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, BinaryIO
+
+from app.config import settings
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def get_io_executor() -> ThreadPoolExecutor:
+    # Separate from the anyio threadpool so slow storage calls cannot starve ordinary sync routes.
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.storage_io_workers,
+                    thread_name_prefix="storage-io",
+                )
+    return _executor
+
+
+async def run_blocking_io(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_io_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def aiter_file(stream: BinaryIO, chunk_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+    while chunk := await run_blocking_io(stream.read, chunk_size):
+        yield chunk
+
+
+class BlockingStorageMixin:
+    # Async facade for SDK-based backends (boto3, googleapiclient) that only offer blocking calls.
+
+    async def upload_file_async(
+        self,
+        filename: str,
+        stream: BinaryIO,
+        content_type: str = "application/octet-stream",
+        user_id: int | None = None,
+    ) -> str:
+        return await run_blocking_io(
+            self.upload_file,
+            filename=filename,
+            stream=stream,
+            content_type=content_type,
+            user_id=user_id,
+        )
+
+    async def download_file_async(self, file_id: str) -> bytes:
+        return await run_blocking_io(self.download_file, file_id)
+
+    async def delete_file_async(self, file_id: str) -> None:
+        await run_blocking_io(self.delete_file, file_id)
+
+    async def aclose(self) -> None:
+        pass
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import os
+import shutil
+from typing import BinaryIO
+from uuid import uuid4
+
+from app.config import settings
+from app.storage_io import BlockingStorageMixin
+
+
+class LocalStorage(BlockingStorageMixin):
+    def __init__(self):
+        if not settings.local_storage_root:
+            raise RuntimeError("LOCAL_STORAGE_ROOT is empty")
+        self.root = os.path.realpath(settings.local_storage_root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _object_key(self, filename: str, user_id: int | None = None) -> str:
+        safe_name = os.path.basename(filename or "track.bin")
+        object_id = uuid4().hex
+        prefix = f"user_{user_id}" if user_id else "shared"
+        # Two hex levels keep directories small even for very large libraries.
+        return f"{prefix}/{object_id[:2]}/{object_id[2:4]}/{object_id}_{safe_name}"
+
+    def local_path(self, object_key: str) -> str:
+        # Keys can come from clients (TrackCreate.remote_file_key), so never resolve outside the root.
+        path = os.path.realpath(os.path.join(self.root, object_key))
+        if not path.startswith(self.root + os.sep):
+            raise RuntimeError("Invalid object key")
+        return path
+
+    def upload_file(
+        self,
+        filename: str,
+        stream: BinaryIO,
+        content_type: str = "application/octet-stream",
+        user_id: int | None = None,
+    ) -> str:
+        object_key = self._object_key(filename=filename, user_id=user_id)
+        path = self.local_path(object_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name and renamed, so readers never see a partial file.
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as out:
+                shutil.copyfileobj(stream, out, 1024 * 1024)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return object_key
+
+    def download_file(self, object_key: str) -> bytes:
+        with open(self.local_path(object_key), "rb") as handle:
+            return handle.read()
+
+    def delete_file(self, object_key: str) -> None:
+        try:
+            os.remove(self.local_path(object_key))
+        except FileNotFoundError:
+            pass
+
+    def ping(self, timeout: float = 5) -> None:
+        if not os.access(self.root, os.W_OK):
+            raise RuntimeError(f"LOCAL_STORAGE_ROOT is not writable: {self.root}")
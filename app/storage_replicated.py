@@ -0,0 +1,297 @@
+from __future__ import annotations
+
+import logging
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from sqlalchemy.exc import IntegrityError
+
+from app.config import settings
+from app.database import SessionLocal
+from app.models import StorageObjectReplica
+from app.storage_io import BlockingStorageMixin
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        # Half-open lets traffic through again; the next failure re-opens immediately.
+        return self.state != "open"
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 256):
+        self.samples: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        with self._lock:
+            if not self.samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _Replica:
+    def __init__(self, name: str, storage):
+        self.name = name
+        self.storage = storage
+        self.breaker = CircuitBreaker(settings.storage_breaker_failures, settings.storage_breaker_reset_seconds)
+        # Downloads only: read ordering and the hedge delay must not follow large uploads or pings.
+        self.latency = LatencyTracker()
+
+    def call(self, method: str, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = getattr(self.storage, method)(*args, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        if method == "download_file":
+            self.latency.record(time.perf_counter() - started)
+        return result
+
+
+class ReplicatedStorage(BlockingStorageMixin):
+    def __init__(self, primary: str, secondary: str):
+        from app.storage_factory import build_storage
+
+        if primary == secondary or "replicated" in (primary, secondary):
+            raise RuntimeError("STORAGE_PRIMARY and STORAGE_SECONDARY must be two different backends")
+        self.replicas = [_Replica(primary, build_storage(primary)), _Replica(secondary, build_storage(secondary))]
+        self._replicator = ThreadPoolExecutor(
+            max_workers=settings.storage_replication_workers,
+            thread_name_prefix="storage-replicate",
+        )
+        self._readers = ThreadPoolExecutor(max_workers=16, thread_name_prefix="storage-read")
+
+    def _record_location(self, object_key: str, replica: _Replica, backend_key: str):
+        db = SessionLocal()
+        try:
+            db.add(StorageObjectReplica(object_key=object_key, backend=replica.name, backend_key=backend_key))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+        finally:
+            db.close()
+
+    def _forget_locations(self, object_key: str, backends: list[str]):
+        db = SessionLocal()
+        try:
+            db.query(StorageObjectReplica).filter(
+                StorageObjectReplica.object_key == object_key,
+                StorageObjectReplica.backend.in_(backends),
+            ).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _recorded_elsewhere(self, object_key: str, backend: str) -> bool:
+        db = SessionLocal()
+        try:
+            row = (
+                db.query(StorageObjectReplica.id)
+                .filter(StorageObjectReplica.object_key == object_key, StorageObjectReplica.backend != backend)
+                .first()
+            )
+            return row is not None
+        finally:
+            db.close()
+
+    def _locations(self, object_key: str) -> dict[str, str]:
+        db = SessionLocal()
+        try:
+            rows = db.query(StorageObjectReplica).filter(StorageObjectReplica.object_key == object_key).all()
+            locations = {row.backend: row.backend_key for row in rows}
+        finally:
+            db.close()
+        # Objects written before replication was enabled only exist on the primary.
+        return locations or {self.replicas[0].name: object_key}
+
+    def _drop_if_deleted(self, object_key: str, target: _Replica, backend_key: str):
+        # Checked after recording: a delete that started earlier missed this copy, so it is undone here;
+        # one that starts later sees the new row and deletes the copy itself.
+        try:
+            if self._recorded_elsewhere(object_key, target.name):
+                return
+            logger.info("%s was deleted while it replicated; removing the copy on %s", object_key, target.name)
+            target.call("delete_file", backend_key)
+            self._forget_locations(object_key, [target.name])
+        except Exception:
+            logger.exception("Could not remove replica of deleted object %s from %s", object_key, target.name)
+
+    def _replicate(self, object_key: str, target: _Replica, spool, filename, content_type, user_id):
+        try:
+            for attempt in range(3):
+                if target.breaker.allow():
+                    try:
+                        spool.seek(0)
+                        backend_key = target.call(
+                            "upload_file",
+                            filename=filename,
+                            stream=spool,
+                            content_type=content_type,
+                            user_id=user_id,
+                        )
+                        self._record_location(object_key, target, backend_key)
+                        self._drop_if_deleted(object_key, target, backend_key)
+                        return
+                    except Exception:
+                        logger.warning(
+                            "Replication of %s to %s failed (attempt %d)", object_key, target.name, attempt + 1
+                        )
+                time.sleep(2**attempt)
+            logger.error("Giving up replicating %s to %s", object_key, target.name)
+        finally:
+            spool.close()
+
+    def upload_file(
+        self,
+        filename: str,
+        stream,
+        content_type: str = "application/octet-stream",
+        user_id: int | None = None,
+    ) -> str:
+        # Spool once so the same bytes can be replayed to the second backend later.
+        spool = tempfile.SpooledTemporaryFile(max_size=settings.storage_spool_max_memory)
+        while chunk := stream.read(1024 * 1024):
+            spool.write(chunk)
+
+        errors = []
+        for index, writer in enumerate(self.replicas):
+            if not writer.breaker.allow():
+                errors.append(f"{writer.name}: circuit open")
+                continue
+            try:
+                spool.seek(0)
+                object_key = writer.call(
+                    "upload_file",
+                    filename=filename,
+                    stream=spool,
+                    content_type=content_type,
+                    user_id=user_id,
+                )
+            except Exception as exc:
+                errors.append(f"{writer.name}: {exc}")
+                continue
+            self._record_location(object_key, writer, object_key)
+            other = self.replicas[1 - index]
+            self._replicator.submit(self._replicate, object_key, other, spool, filename, content_type, user_id)
+            return object_key
+
+        spool.close()
+        raise RuntimeError("Upload failed on all storage replicas: " + "; ".join(errors))
+
+    def _read_order(self, locations: dict[str, str]) -> list[_Replica]:
+        candidates = [replica for replica in self.replicas if replica.name in locations]
+        healthy = [replica for replica in candidates if replica.breaker.allow()]
+        # Fastest median first; replicas without samples yet keep their configured order.
+        return sorted(healthy, key=lambda replica: replica.latency.percentile(0.5) or 0.0) or candidates
+
+    def download_file(self, object_key: str) -> bytes:
+        locations = self._locations(object_key)
+        order = self._read_order(locations)
+        pending = {}
+        errors = []
+
+        first = order[0]
+        pending[self._readers.submit(first.call, "download_file", locations[first.name])] = first
+        hedge_delay = (
+            first.latency.percentile(settings.storage_hedge_percentile) or settings.storage_hedge_default_seconds
+        )
+        backups = order[1:]
+
+        while pending:
+            timeout = hedge_delay if backups else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                replica = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as exc:
+                    errors.append(f"{replica.name}: {exc}")
+            if backups and (not done or not pending):
+                # Either the first read is slower than its usual tail latency, or it failed: hedge.
+                backup = backups.pop(0)
+                pending[self._readers.submit(backup.call, "download_file", locations[backup.name])] = backup
+
+        raise RuntimeError("Download failed on all storage replicas: " + "; ".join(errors))
+
+    def delete_file(self, object_key: str) -> None:
+        locations = self._locations(object_key)
+        errors = []
+        deleted = []
+        for replica in self.replicas:
+            if replica.name not in locations:
+                continue
+            try:
+                replica.call("delete_file", locations[replica.name])
+            except Exception as exc:
+                errors.append(f"{replica.name}: {exc}")
+            else:
+                deleted.append(replica.name)
+        # Rows of replicas that failed stay, so the leftover object is still on record.
+        self._forget_locations(object_key, deleted)
+        if errors:
+            raise RuntimeError("Delete failed on storage replicas: " + "; ".join(errors))
+
+    def ping(self, timeout: float = 5) -> None:
+        # Degraded (one replica down) still serves traffic; only a total outage fails the check.
+        errors = []
+        for replica in self.replicas:
+            try:
+                replica.call("ping", timeout=timeout)
+            except Exception as exc:
+                errors.append(f"{replica.name}: {exc}")
+        if len(errors) == len(self.replicas):
+            raise RuntimeError("; ".join(errors))
+
+    async def aclose(self) -> None:
+        for replica in self.replicas:
+            await replica.storage.aclose()
+
+    def status(self) -> list[dict]:
+        return [
+            {
+                "backend": replica.name,
+                "circuit": replica.breaker.state,
+                "p50_ms": round((replica.latency.percentile(0.5) or 0) * 1000, 2),
+                "p95_ms": round((replica.latency.percentile(0.95) or 0) * 1000, 2),
+            }
+            for replica in self.replicas
+        ]
@@ -5,12 +5,14 @@ from datetime import datetime
 from urllib.parse import quote
 from uuid import uuid4
 
+import httpx
 import requests
 
 from app.config import settings
+from app.storage_io import BlockingStorageMixin, aiter_file, run_blocking_io
 
 
-class SupabaseStorage:
+class SupabaseStorage(BlockingStorageMixin):
     def __init__(self):
         if not settings.supabase_url:
             raise RuntimeError("SUPABASE_URL is empty")
@@ -20,6 +22,9 @@ class SupabaseStorage:
         self.base_url = settings.supabase_url.rstrip("/")
         self.bucket = settings.supabase_bucket
         self.s3_client = None
+        # Keep-alive session: reuses the TLS connection across uploads/downloads.
+        self.http = requests.Session()
+        self._async_http: httpx.AsyncClient | None = None
 
         # Option A: S3-compatible API (access key + secret)
         if settings.supabase_s3_access_key_id and settings.supabase_s3_secret_access_key:
@@ -54,6 +59,19 @@ class SupabaseStorage:
         prefix = f"user_{user_id}" if user_id else "shared"
         return f"{prefix}/{stamp}/{uuid4().hex}_{safe_name}"
 
+    def _object_url(self, object_path: str) -> str:
+        return f"{self.base_url}/storage/v1/object/{self.bucket}/{quote(object_path, safe='/')}"
+
+    def _async_client(self) -> httpx.AsyncClient:
+        if self._async_http is None or self._async_http.is_closed:
+            self._async_http = httpx.AsyncClient(timeout=settings.supabase_timeout_seconds)
+        return self._async_http
+
+    async def aclose(self) -> None:
+        if self._async_http is not None and not self._async_http.is_closed:
+            await self._async_http.aclose()
+        self.http.close()
+
     def upload_file(
         self,
         filename: str,
@@ -72,14 +90,14 @@ class SupabaseStorage:
             )
             return object_path
 
-        url = f"{self.base_url}/storage/v1/object/{self.bucket}/{quote(object_path, safe='/')}"
+        url = self._object_url(object_path)
         data = stream.read()
         headers = {
             **self.headers,
             "Content-Type": content_type,
             "x-upsert": "true",
         }
-        response = requests.post(url, headers=headers, data=data, timeout=120)
+        response = self.http.post(url, headers=headers, data=data, timeout=settings.supabase_timeout_seconds)
         if response.status_code >= 300:
             raise RuntimeError(f"Supabase upload failed: {response.status_code} {response.text}")
         return object_path
@@ -89,8 +107,66 @@ class SupabaseStorage:
             response = self.s3_client.get_object(Bucket=self.bucket, Key=object_path)
             return response["Body"].read()
 
-        url = f"{self.base_url}/storage/v1/object/{self.bucket}/{quote(object_path, safe='/')}"
-        response = requests.get(url, headers=self.headers, timeout=120)
+        url = self._object_url(object_path)
+        response = self.http.get(url, headers=self.headers, timeout=settings.supabase_timeout_seconds)
+        if response.status_code >= 300:
+            raise RuntimeError(f"Supabase download failed: {response.status_code} {response.text}")
+        return response.content
+
+    def delete_file(self, object_path: str) -> None:
+        if self.s3_client is not None:
+            self.s3_client.delete_object(Bucket=self.bucket, Key=object_path)
+            return
+
+        url = self._object_url(object_path)
+        response = self.http.delete(url, headers=self.headers, timeout=settings.supabase_timeout_seconds)
+        if response.status_code >= 300 and response.status_code != 404:
+            raise RuntimeError(f"Supabase delete failed: {response.status_code} {response.text}")
+
+    async def upload_file_async(
+        self,
+        filename: str,
+        stream,
+        content_type: str = "application/octet-stream",
+        user_id: int | None = None,
+    ) -> str:
+        if self.s3_client is not None:
+            return await super().upload_file_async(filename, stream, content_type, user_id)
+
+        object_path = self._object_path(filename=filename, user_id=user_id)
+        size = await run_blocking_io(stream.seek, 0, os.SEEK_END)
+        await run_blocking_io(stream.seek, 0)
+        headers = {
+            **self.headers,
+            "Content-Type": content_type,
+            "Content-Length": str(size),
+            "x-upsert": "true",
+        }
+        # Body is streamed chunk by chunk instead of being read into memory first.
+        response = await self._async_client().post(
+            self._object_url(object_path),
+            headers=headers,
+            content=aiter_file(stream),
+        )
+        if response.status_code >= 300:
+            raise RuntimeError(f"Supabase upload failed: {response.status_code} {response.text}")
+        return object_path
+
+    async def download_file_async(self, object_path: str) -> bytes:
+        if self.s3_client is not None:
+            return await super().download_file_async(object_path)
+
+        response = await self._async_client().get(self._object_url(object_path), headers=self.headers)
         if response.status_code >= 300:
             raise RuntimeError(f"Supabase download failed: {response.status_code} {response.text}")
         return response.content
+
+    def ping(self, timeout: float = 5) -> None:
+        if self.s3_client is not None:
+            self.s3_client.head_bucket(Bucket=self.bucket)
+            return
+
+        url = f"{self.base_url}/storage/v1/bucket/{quote(self.bucket, safe='')}"
+        response = self.http.get(url, headers=self.headers, timeout=timeout)
+        if response.status_code >= 300:
+            raise RuntimeError(f"Supabase ping failed: {response.status_code} {response.text}")
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import hashlib
+from datetime import datetime
+from typing import BinaryIO
+
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import upsert_increment
+from app.models import LibraryTrack, UserStorageUsage
+
+
+def measure_stream(stream: BinaryIO, chunk_size: int = 1024 * 1024) -> tuple[int, str]:
+    # One pass over the spooled upload gives both the size and the sha256; the stream is rewound after.
+    digest = hashlib.sha256()
+    size = 0
+    stream.seek(0)
+    while chunk := stream.read(chunk_size):
+        digest.update(chunk)
+        size += len(chunk)
+    stream.seek(0)
+    return size, digest.hexdigest()
+
+
+def _adjust(db: Session, user_id: int, delta_bytes: int, delta_objects: int = 0):
+    db.execute(
+        update(UserStorageUsage)
+        .where(UserStorageUsage.user_id == user_id)
+        .values(
+            bytes_used=UserStorageUsage.bytes_used + delta_bytes,
+            object_count=UserStorageUsage.object_count + delta_objects,
+            updated_at=datetime.utcnow(),
+        )
+    )
+
+
+def reserve_bytes(db: Session, user_id: int, size: int) -> bool:
+    upsert_increment(
+        db,
+        UserStorageUsage,
+        [{"user_id": user_id, "bytes_used": 0, "object_count": 0}],
+        counters=("bytes_used", "object_count"),
+    )
+    # The quota check and the increment are one conditional UPDATE, so concurrent uploads cannot overshoot.
+    stmt = (
+        update(UserStorageUsage)
+        .where(UserStorageUsage.user_id == user_id)
+        .values(bytes_used=UserStorageUsage.bytes_used + size, updated_at=datetime.utcnow())
+    )
+    if settings.storage_quota_bytes > 0:
+        stmt = stmt.where(UserStorageUsage.bytes_used + size <= settings.storage_quota_bytes)
+    reserved = db.execute(stmt).rowcount == 1
+    db.commit()
+    return reserved
+
+
+def release_reservation(db: Session, user_id: int, size: int):
+    db.rollback()
+    _adjust(db, user_id, -size)
+    db.commit()
+
+
+def count_uploaded_object(db: Session, user_id: int):
+    # Bytes were already reserved; this runs in the same transaction as the track insert.
+    _adjust(db, user_id, 0, 1)
+
+
+def release_uploaded_object(db: Session, row: LibraryTrack):
+    # Runs in the same transaction as the track delete.
+    _adjust(db, row.user_id, -(row.size_bytes or 0), -1)
+
+
+def get_usage(db: Session, user_id: int) -> dict:
+    row = db.get(UserStorageUsage, user_id)
+    return {
+        "bytes_used": row.bytes_used if row else 0,
+        "object_count": row.object_count if row else 0,
+        "quota_bytes": settings.storage_quota_bytes,
+        "max_upload_bytes": settings.max_upload_bytes,
+    }
+
+
+def rebuild_storage_usage(db: Session):
+    # Recomputes the counters from library_tracks, e.g. after a restore.
+    db.query(UserStorageUsage).delete(synchronize_session=False)
+    db.execute(
+        insert(UserStorageUsage).from_select(
+            ["user_id", "bytes_used", "object_count", "updated_at"],
+            select(
+                LibraryTrack.user_id,
+                func.coalesce(func.sum(LibraryTrack.size_bytes), 0),
+                func.count(LibraryTrack.id),
+                func.now(),
+            )
+            .where(LibraryTrack.content_hash.is_not(None))
+            .group_by(LibraryTrack.user_id),
+        )
+    )
+    db.commit()
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import logging
+import time
+from typing import Callable
+
+from sqlalchemy import text
+
+from app.config import settings
+from app.database import engine, shard_engines
+from app.storage_factory import get_storage
+
+logger = logging.getLogger(__name__)
+
+_CACHE_PRIMERS: list[tuple[str, Callable[[], None]]] = []
+_WARMUP_STATE: dict = {"done": False, "checks": {}}
+
+
+def register_cache_primer(name: str, primer: Callable[[], None]):
+    _CACHE_PRIMERS.append((name, primer))
+
+
+def _timed(check: Callable[[], None]) -> dict:
+    started = time.perf_counter()
+    try:
+        check()
+    except Exception as exc:
+        return {
+            "ok": False,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 2),
+            "error": str(exc),
+        }
+    return {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+
+def _fill_db_pool(db_engine=engine):
+    # Check out several connections at once so the pool keeps that many open.
+    connections = []
+    try:
+        for _ in range(max(1, settings.db_pool_min_size)):
+            conn = db_engine.connect()
+            connections.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in connections:
+            conn.close()
+
+
+def _check_database(db_engine=engine):
+    with db_engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+
+def _shard_checks(check: Callable) -> dict:
+    # Library shards other than the main database.
+    return {
+        f"database:shard{index}": _timed(lambda shard_engine=shard_engine: check(shard_engine))
+        for index, shard_engine in enumerate(shard_engines)
+        if shard_engine is not engine
+    }
+
+
+def _check_storage():
+    get_storage().ping(timeout=settings.readiness_timeout_seconds)
+
+
+def warm_up() -> dict:
+    checks = {
+        "database": _timed(_fill_db_pool),
+        **_shard_checks(_fill_db_pool),
+        "storage": _timed(_check_storage),
+    }
+    for name, primer in _CACHE_PRIMERS:
+        checks[f"cache:{name}"] = _timed(primer)
+    for name, result in checks.items():
+        if not result["ok"]:
+            logger.warning("Warm-up step %s failed: %s", name, result["error"])
+
+    _WARMUP_STATE["checks"] = checks
+    _WARMUP_STATE["done"] = True
+    return checks
+
+
+def readiness() -> tuple[bool, dict]:
+    checks = {
+        "database": _timed(_check_database),
+        **_shard_checks(_check_database),
+        "storage": _timed(_check_storage),
+    }
+    if checks["storage"]["ok"]:
+        storage = get_storage()
+        if hasattr(storage, "status"):
+            checks["storage"]["replicas"] = storage.status()
+    warmed_up = bool(_WARMUP_STATE["done"]) or not settings.warmup_enabled
+    ready = warmed_up and all(result["ok"] for result in checks.values())
+    return ready, {
+        "status": "ready" if ready else "not_ready",
+        "warmed_up": warmed_up,
+        "checks": checks,
+        "warmup": _WARMUP_STATE["checks"],
+    }
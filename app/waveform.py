@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import wave
+from datetime import datetime
+from typing import BinaryIO
+
+from starlette.concurrency import run_in_threadpool
+
+from app.config import settings
+from app.cpu_pool import run_cpu_bound
+from app.database import library_session
+from app.models import LibraryTrack, TrackWaveform
+from app.storage_factory import get_storage
+
+logger = logging.getLogger(__name__)
+
+READY = "ready"
+FAILED = "failed"
+
+# Track ids are only unique per shard, so jobs are keyed by (user_id, track_id).
+_in_flight: set[tuple[int, int]] = set()
+_tasks: set[asyncio.Task] = set()
+
+
+def waveform_resolutions() -> tuple[int, ...]:
+    return tuple(sorted(settings.waveform_resolutions))
+
+
+def stored_resolutions(row: TrackWaveform) -> tuple[int, ...]:
+    return tuple(int(part) for part in row.resolutions.split(",") if part)
+
+
+def pick_resolution(requested: int, resolutions: tuple[int, ...]) -> int:
+    for resolution in resolutions:
+        if resolution >= requested:
+            return resolution
+    return resolutions[-1]
+
+
+def waveform_etag(file_id: str, resolution: int) -> str:
+    # The stored object never changes under a given key, so neither do its peaks.
+    return f'"{hashlib.sha256(file_id.encode("utf-8")).hexdigest()[:24]}-wf{resolution}"'
+
+
+def spool_to_temp(stream: BinaryIO) -> str:
+    # The job reads its input from disk, so neither this process nor the pool holds the whole file.
+    stream.seek(0)
+    with tempfile.NamedTemporaryFile(prefix="waveform-", delete=False) as target:
+        shutil.copyfileobj(stream, target, 1024 * 1024)
+    return target.name
+
+
+def _write_temp(data: bytes) -> str:
+    with tempfile.NamedTemporaryFile(prefix="waveform-", delete=False) as target:
+        target.write(data)
+    return target.name
+
+
+def _remove(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _is_wav(path: str) -> bool:
+    with open(path, "rb") as source:
+        header = source.read(12)
+    return header[:4] == b"RIFF" and header[8:12] == b"WAVE"
+
+
+def _decode_wav(path: str):
+    import numpy as np
+
+    with wave.open(path) as source:
+        channels = source.getnchannels()
+        width = source.getsampwidth()
+        frames = source.readframes(source.getnframes())
+    if width == 1:
+        samples = np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128.0
+        scale = 128.0
+    elif width == 2:
+        samples = np.frombuffer(frames, dtype="<i2").astype(np.float32)
+        scale = 32768.0
+    elif width == 4:
+        samples = np.frombuffer(frames, dtype="<i4").astype(np.float32)
+        scale = 2147483648.0
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {width}")
+    return samples.reshape(-1, channels).mean(axis=1) / scale
+
+
+def _decode_ffmpeg(path: str):
+    import numpy as np
+
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise ValueError("ffmpeg is required to decode non-WAV audio")
+    # Mono at a low rate is plenty for peaks and keeps the decoded buffer small.
+    command = [ffmpeg, "-v", "error", "-i", path, "-f", "s16le", "-ac", "1"]
+    command += ["-ar", str(settings.waveform_sample_rate), "pipe:1"]
+    result = subprocess.run(
+        command,
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        timeout=settings.waveform_decode_timeout_seconds,
+    )
+    if result.returncode != 0:
+        raise ValueError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace').strip()[:200]}")
+    return np.frombuffer(result.stdout, dtype="<i2").astype(np.float32) / 32768.0
+
+
+def compute_peaks(path: str, resolutions: tuple[int, ...]) -> bytes:
+    # Runs in a worker process. Output: for each resolution (ascending), `resolution` interleaved
+    # int8 (min, max) pairs; shorter tracks are zero-padded so offsets depend only on the resolutions.
+    import numpy as np
+
+    samples = _decode_wav(path) if _is_wav(path) else _decode_ffmpeg(path)
+    if samples.size == 0:
+        raise ValueError("No audio samples decoded")
+
+    chunks = []
+    for resolution in sorted(resolutions):
+        window = -(-samples.size // resolution)
+        padded = np.zeros(window * resolution, dtype=np.float32)
+        padded[: samples.size] = samples
+        frames = padded.reshape(resolution, window)
+        pairs = np.empty((resolution, 2), dtype=np.float32)
+        pairs[:, 0] = frames.min(axis=1)
+        pairs[:, 1] = frames.max(axis=1)
+        chunks.append(np.clip(np.round(pairs * 127.0), -127, 127).astype(np.int8).tobytes())
+    return b"".join(chunks)
+
+
+def slice_peaks(peaks: bytes, resolutions: tuple[int, ...], resolution: int) -> bytes:
+    offset = 0
+    for current in sorted(resolutions):
+        if current == resolution:
+            return peaks[offset : offset + 2 * current]
+        offset += 2 * current
+    raise KeyError(resolution)
+
+
+def _store(user_id: int, track_id: int, resolutions: tuple[int, ...], peaks: bytes | None, error: str | None):
+    db = library_session(user_id)
+    try:
+        track = db.get(LibraryTrack, track_id)
+        if track is None or track.user_id != user_id:
+            # Deleted, or the library moved shards (and was renumbered) while the job ran.
+            return
+        row = db.get(TrackWaveform, track_id)
+        if row is None:
+            row = TrackWaveform(track_id=track_id)
+            db.add(row)
+        row.status = READY if peaks is not None else FAILED
+        row.resolutions = ",".join(str(resolution) for resolution in resolutions)
+        row.peaks = peaks
+        row.error = error
+        row.updated_at = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+
+
+def _source(user_id: int, track_id: int) -> tuple[str | None, int]:
+    db = library_session(user_id)
+    try:
+        row = db.get(LibraryTrack, track_id)
+        if row is None or row.user_id != user_id:
+            return None, 0
+        return row.remote_file_key, row.size_bytes or 0
+    finally:
+        db.close()
+
+
+async def _download_to_temp(user_id: int, track_id: int, resolutions: tuple[int, ...]) -> str | None:
+    file_id, size = await run_in_threadpool(_source, user_id, track_id)
+    if not file_id:
+        return None
+    too_large = "Source file is too large"
+    if size > settings.waveform_max_source_bytes:
+        # Known for uploads made here, so the object is not even downloaded.
+        await run_in_threadpool(_store, user_id, track_id, resolutions, None, too_large)
+        return None
+    storage = await run_in_threadpool(get_storage)
+    data = await storage.download_file_async(file_id)
+    if len(data) > settings.waveform_max_source_bytes:
+        await run_in_threadpool(_store, user_id, track_id, resolutions, None, too_large)
+        return None
+    return await run_in_threadpool(_write_temp, data)
+
+
+async def generate_waveform(user_id: int, track_id: int, path: str | None = None):
+    # At most one job per track per process; `path` is a temp copy of the upload, otherwise the
+    # object is downloaded. Either way the temp file belongs to this job and is removed at the end.
+    job = (user_id, track_id)
+    if job in _in_flight:
+        if path is not None:
+            await run_in_threadpool(_remove, path)
+        return
+    _in_flight.add(job)
+    resolutions = waveform_resolutions()
+    try:
+        if path is None:
+            path = await _download_to_temp(user_id, track_id, resolutions)
+            if path is None:
+                return
+        try:
+            peaks = await run_cpu_bound(compute_peaks, path, resolutions)
+        except Exception as exc:
+            logger.warning("Waveform for track %s failed: %s", track_id, exc)
+            await run_in_threadpool(_store, user_id, track_id, resolutions, None, str(exc)[:500])
+            return
+        await run_in_threadpool(_store, user_id, track_id, resolutions, peaks, None)
+    except Exception as exc:
+        logger.exception("Waveform job for track %s failed", track_id)
+        # Recorded so clients stop polling; the GET route retries it after WAVEFORM_RETRY_SECONDS.
+        error = str(exc)[:500] or type(exc).__name__
+        try:
+            await run_in_threadpool(_store, user_id, track_id, resolutions, None, error)
+        except Exception:
+            logger.exception("Could not record waveform failure for track %s", track_id)
+    finally:
+        _in_flight.discard(job)
+        if path is not None:
+            await run_in_threadpool(_remove, path)
+
+
+def is_retryable(row: TrackWaveform) -> bool:
+    if row.status != FAILED:
+        return False
+    failed_at = row.updated_at or row.created_at
+    return failed_at is None or (datetime.utcnow() - failed_at).total_seconds() >= settings.waveform_retry_seconds
+
+
+def schedule_waveform(user_id: int, track_id: int, path: str | None = None) -> bool:
+    if path is None and (user_id, track_id) in _in_flight:
+        return False
+    task = asyncio.get_running_loop().create_task(generate_waveform(user_id, track_id, path))
+    # The loop only keeps weak references to tasks.
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return True
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.backup import gzip_chunks, iter_export_lines, iter_lines, restore_lines
+from app.config import settings
+from app.database import Base
+
+
+def _session_factory(database_url: str):
+    is_sqlite = database_url.startswith("sqlite")
+    engine = create_engine(database_url, connect_args={"check_same_thread": False} if is_sqlite else {})
+    return engine, sessionmaker(bind=engine, autocommit=False, autoflush=False)
+
+
+def _read_file(path: str):
+    handle = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        while chunk := handle.read(1024 * 1024):
+            yield chunk
+    finally:
+        if handle is not sys.stdin.buffer:
+            handle.close()
+
+
+def export(args) -> int:
+    _, session_factory = _session_factory(args.database_url)
+    db = session_factory()
+    out = sys.stdout.buffer if args.out == "-" else open(args.out, "wb")
+    try:
+        chunks = iter_export_lines(db, batch_size=args.batch_size)
+        for chunk in gzip_chunks(chunks) if args.gzip else chunks:
+            out.write(chunk)
+    finally:
+        db.close()
+        if out is not sys.stdout.buffer:
+            out.close()
+    return 0
+
+
+def restore(args) -> int:
+    engine, session_factory = _session_factory(args.database_url)
+    Base.metadata.create_all(bind=engine)
+
+    checkpoint = {}
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        with open(args.checkpoint, encoding="utf-8") as handle:
+            checkpoint = json.load(handle)
+        print(f"Resuming after {checkpoint}", file=sys.stderr)
+
+    def save_checkpoint(state: dict[str, int]):
+        if not args.checkpoint:
+            return
+        tmp_path = args.checkpoint + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            json.dump(state, handle)
+        os.replace(tmp_path, args.checkpoint)
+
+    result = restore_lines(
+        session_factory,
+        iter_lines(_read_file(args.input)),
+        batch_size=args.batch_size,
+        checkpoint=checkpoint,
+        on_commit=save_checkpoint,
+    )
+    print(json.dumps(result), file=sys.stderr)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Stream users and library rows to/from NDJSON")
+    parser.add_argument("--database-url", default=settings.database_url)
+    parser.add_argument("--batch-size", type=int, default=settings.backup_batch_size)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_cmd = commands.add_parser("export")
+    export_cmd.add_argument("--out", default="-")
+    export_cmd.add_argument("--gzip", action="store_true")
+    export_cmd.set_defaults(handler=export)
+
+    restore_cmd = commands.add_parser("restore")
+    restore_cmd.add_argument("--in", dest="input", default="-")
+    restore_cmd.add_argument("--checkpoint", help="JSON file with the last committed id per row type")
+    restore_cmd.set_defaults(handler=restore)
+
+    args = parser.parse_args()
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -2,17 +2,33 @@ from __future__ import annotations
 
 import os
 import sys
+import time
 import requests
 
 
+def _print_checks(title: str, checks: dict) -> None:
+    for name, result in checks.items():
+        state = "ok" if result.get("ok") else f"FAIL ({result.get('error', '')})"
+        print(f"  {title} {name}: {state} {result.get('latency_ms')} ms")
+
+
 def main() -> int:
     url = (os.getenv("KEEPALIVE_URL") or "").strip()
     if not url:
         print("KEEPALIVE_URL is not set")
         return 2
     try:
+        started = time.perf_counter()
         r = requests.get(url, timeout=20)
-        print(f"GET {url} -> {r.status_code}")
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        print(f"GET {url} -> {r.status_code} in {elapsed_ms:.0f} ms")
+        # /health/ready reports per-dependency readiness and latency.
+        if r.headers.get("content-type", "").startswith("application/json"):
+            body = r.json()
+            if isinstance(body, dict) and "checks" in body:
+                print(f"  status: {body.get('status')}, warmed_up: {body.get('warmed_up')}")
+                _print_checks("check", body.get("checks") or {})
+                _print_checks("warmup", body.get("warmup") or {})
         return 0 if r.status_code < 500 else 1
     except Exception as e:
         print(f"Ping failed: {e}")
@@ -1,30 +1,80 @@
 ﻿from __future__ import annotations
 
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from sqlalchemy import inspect, text
 
+from app.admission import AdmissionMiddleware
 from app.config import settings
-from app.database import Base, engine
+from app.cpu_pool import shutdown_process_pool
+from app.database import Base, engine, shard_engines, shard_sessions
+from app.library_sync import ensure_sync_buckets
 from app.routes_auth import router as auth_router
+from app.play_events import start_play_event_writer, stop_play_event_writer
+from app.storage_factory import close_storage
+from app.routes_admin import router as admin_router
 from app.routes_library import router as library_router
+from app.routes_playlists import router as playlists_router
+from app.routes_stats import router as stats_router
+from app.warmup import readiness, warm_up
 
 app = FastAPI(title=settings.app_name, debug=settings.app_debug)
+app.add_middleware(AdmissionMiddleware)
 
 
 @app.on_event("startup")
 def startup_event():
-    Base.metadata.create_all(bind=engine)
-    _run_compat_migrations()
+    for db_engine in [engine, *(shard_engine for shard_engine in shard_engines if shard_engine is not engine)]:
+        Base.metadata.create_all(bind=db_engine)
+        _run_compat_migrations(db_engine)
+    _ensure_sync_buckets()
+    start_play_event_writer()
+    if settings.warmup_enabled:
+        warm_up()
 
 
-def _run_compat_migrations():
-    inspector = inspect(engine)
-    if "users" not in inspector.get_table_names():
-        return
-    user_cols = {c["name"] for c in inspector.get_columns("users")}
-    if "is_admin" not in user_cols:
-        with engine.begin() as conn:
-            conn.execute(text("ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT FALSE"))
+@app.on_event("shutdown")
+def shutdown_event():
+    stop_play_event_writer()
+    shutdown_process_pool()
+
+
+@app.on_event("shutdown")
+async def close_storage_clients():
+    await close_storage()
+
+
+_COMPAT_COLUMNS = [
+    ("users", "is_admin", "BOOLEAN DEFAULT FALSE"),
+    ("library_tracks", "last_played_at", "TIMESTAMP"),
+    ("library_tracks", "size_bytes", "BIGINT DEFAULT 0"),
+    ("library_tracks", "content_hash", "VARCHAR(64)"),
+    ("library_tracks", "updated_at", "TIMESTAMP"),
+    ("library_tracks", "version", "INTEGER DEFAULT 1 NOT NULL"),
+    ("track_waveforms", "updated_at", "TIMESTAMP"),
+]
+
+
+def _run_compat_migrations(db_engine):
+    inspector = inspect(db_engine)
+    tables = set(inspector.get_table_names())
+    for table, column, ddl in _COMPAT_COLUMNS:
+        if table not in tables:
+            continue
+        cols = {c["name"] for c in inspector.get_columns(table)}
+        if column not in cols:
+            with db_engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _ensure_sync_buckets():
+    # Databases that predate the sync manifest get their bucket digests computed once.
+    for session_factory in shard_sessions:
+        db = session_factory()
+        try:
+            ensure_sync_buckets(db)
+        finally:
+            db.close()
 
 
 @app.get("/health")
@@ -32,5 +82,14 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/health/ready")
+def health_ready():
+    ready, report = readiness()
+    return JSONResponse(status_code=200 if ready else 503, content=report)
+
+
+app.include_router(admin_router)
 app.include_router(auth_router)
-app.include_router(library_router)
+app.include_router(library_router)
+app.include_router(playlists_router)
+app.include_router(stats_router)
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+
+from app.config import settings
+from app.database import Base, engine, shard_engines
+from app.shard_rebalance import move_user, shard_report
+
+
+def _log(message: str):
+    print(message, file=sys.stderr)
+
+
+def status(args) -> int:
+    print(json.dumps(shard_report(args.user_id)))
+    return 0
+
+
+def move(args) -> int:
+    if len(shard_engines) < 2:
+        _log("DATABASE_SHARD_URLS lists fewer than two shards; nothing to move between")
+        return 2
+    for user_id in args.user_id:
+        result = move_user(user_id, args.to, grace_seconds=args.grace, batch_size=args.batch_size, log=_log)
+        print(json.dumps(result))
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Inspect and rebalance per-user library shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    status_cmd = commands.add_parser("status")
+    status_cmd.add_argument("--user-id", type=int)
+    status_cmd.set_defaults(handler=status)
+
+    move_cmd = commands.add_parser("move")
+    move_cmd.add_argument("--user-id", type=int, action="append", required=True)
+    move_cmd.add_argument("--to", type=int, required=True)
+    move_cmd.add_argument(
+        "--grace",
+        type=float,
+        help="Seconds to wait after blocking writes (default: 2 x TTL + play event flush interval)",
+    )
+    move_cmd.add_argument("--batch-size", type=int, default=settings.shard_move_batch_size)
+    move_cmd.set_defaults(handler=move)
+
+    args = parser.parse_args()
+    for db_engine in {engine, *shard_engines}:
+        Base.metadata.create_all(bind=db_engine)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,17 @@
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+
+# Settings are read at import time, so the environment is prepared before anything imports `app`.
+_tmp = tempfile.mkdtemp(prefix="toporch-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp, 'test.db')}")
+os.environ.setdefault("STORAGE_PROVIDER", "local")
+os.environ.setdefault("LOCAL_STORAGE_ROOT", os.path.join(_tmp, "storage"))
+os.environ.setdefault("JWT_SECRET", "test-secret")
+os.environ.setdefault("WARMUP_ENABLED", "false")
+os.environ.setdefault("WAVEFORM_MAX_SOURCE_BYTES", "0")
+os.environ.setdefault("ADMISSION_ENABLED", "false")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import io
+import itertools
+import re
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("googleapiclient")
+
+from app import storage_google_drive as drive
+from app.storage_google_drive import FOLDER_MIME_TYPE, GoogleDriveStorage, _DriveBatcher
+
+
+class FakeDrive:
+    # Just enough of the Drive v3 files() API for folder lookups, creates and deletes.
+
+    def __init__(self):
+        self.files: dict[str, dict] = {}
+        self.batches: list[int] = []
+        self.fail_next_batch = False
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def run(self, kind: str, kwargs: dict):
+        with self._lock:
+            if kind == "list":
+                query = kwargs["q"]
+                parent = re.search(r"'([^']+)' in parents", query).group(1)
+                name = re.search(r"name = '([^']+)'", query)
+                folders_only = FOLDER_MIME_TYPE in query
+                return {
+                    "files": [
+                        {"id": file_id, "name": row["name"], "createdTime": row["createdTime"]}
+                        for file_id, row in self.files.items()
+                        if row["parent"] == parent
+                        and (name is None or row["name"] == name.group(1))
+                        and (not folders_only or row["mimeType"] == FOLDER_MIME_TYPE)
+                    ]
+                }
+            if kind == "create":
+                body = kwargs["body"]
+                number = next(self._ids)
+                file_id = f"id{number}"
+                self.files[file_id] = {
+                    "name": body["name"],
+                    "parent": body["parents"][0],
+                    "mimeType": body.get("mimeType", "audio/mpeg"),
+                    "createdTime": f"2024-01-01T00:00:{number:06d}Z",
+                }
+                return {"id": file_id}
+            if kind == "delete":
+                self.files.pop(kwargs["fileId"], None)
+                return ""
+        raise AssertionError(kind)
+
+    def folders(self) -> list[tuple[str, str]]:
+        return [(row["name"], row["parent"]) for row in self.files.values() if row["mimeType"] == FOLDER_MIME_TYPE]
+
+
+class FakeRequest:
+    def __init__(self, fake: FakeDrive, kind: str, kwargs: dict):
+        self.fake = fake
+        self.kind = kind
+        self.kwargs = kwargs
+
+    def execute(self, http=None):
+        return self.fake.run(self.kind, self.kwargs)
+
+
+class FakeFiles:
+    def __init__(self, fake: FakeDrive):
+        self.fake = fake
+
+    def list(self, **kwargs):
+        return FakeRequest(self.fake, "list", kwargs)
+
+    def create(self, **kwargs):
+        return FakeRequest(self.fake, "create", kwargs)
+
+    def delete(self, **kwargs):
+        return FakeRequest(self.fake, "delete", kwargs)
+
+
+class FakeBatch:
+    def __init__(self, fake: FakeDrive, callback):
+        self.fake = fake
+        self.callback = callback
+        self.requests: list[tuple[FakeRequest, str]] = []
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self, http=None):
+        self.fake.batches.append(len(self.requests))
+        for request, request_id in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+
+class FakeService:
+    def __init__(self, fake: FakeDrive):
+        self.fake = fake
+
+    def files(self):
+        return FakeFiles(self.fake)
+
+    def new_batch_http_request(self, callback):
+        if self.fake.fail_next_batch:
+            self.fake.fail_next_batch = False
+            raise RuntimeError("batch endpoint unavailable")
+        return FakeBatch(self.fake, callback)
+
+
+def make_storage(fake: FakeDrive, timeout: float = 5) -> GoogleDriveStorage:
+    # One instance per worker process: its own folder cache, locks and batch thread.
+    storage = object.__new__(GoogleDriveStorage)
+    storage.service = FakeService(fake)
+    storage.folder_id = "root"
+    storage._local = threading.local()
+    storage._folder_ids = {"": "root"}
+    storage._folder_locks = {}
+    storage._folder_locks_guard = threading.Lock()
+    storage._batcher = _DriveBatcher(storage.service, lambda: None, 0.03, timeout)
+    storage._http = lambda: None
+    return storage
+
+
+@pytest.fixture(autouse=True)
+def no_media(monkeypatch):
+    monkeypatch.setattr(drive, "MediaIoBaseUpload", lambda stream, mimetype, resumable: None)
+
+
+def _in_threads(target, args_list):
+    threads = [threading.Thread(target=target, args=args) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_concurrent_uploads_batch_calls_without_duplicate_folders():
+    fake = FakeDrive()
+    storage = make_storage(fake)
+
+    def upload(user_id: int):
+        storage.upload_file("a.mp3", io.BytesIO(b"x"), user_id=user_id)
+
+    _in_threads(upload, [(i % 5,) for i in range(60)])
+
+    folders = fake.folders()
+    assert len(folders) == len(set(folders))
+    assert max(fake.batches) > 1
+
+
+def test_workers_racing_on_a_folder_converge_on_one():
+    fake = FakeDrive()
+    workers = [make_storage(fake) for _ in range(4)]
+    results: dict[int, str] = {}
+    barrier = threading.Barrier(len(workers))
+
+    def ensure(index: int):
+        barrier.wait()
+        results[index] = workers[index]._ensure_folder("user_1")
+
+    _in_threads(ensure, [(index,) for index in range(len(workers))])
+
+    assert len(set(results.values())) == 1
+    assert fake.folders() == [("user_1", "root")]
+
+
+def test_failed_batch_fails_its_callers_and_the_thread_keeps_serving():
+    fake = FakeDrive()
+    storage = make_storage(fake)
+    fake.fail_next_batch = True
+    errors: list[BaseException] = []
+
+    def delete(file_id: str):
+        try:
+            storage.delete_file(file_id)
+        except Exception as exc:
+            errors.append(exc)
+
+    _in_threads(delete, [(f"id{i}",) for i in range(10)])
+    assert errors and all(isinstance(exc, RuntimeError) for exc in errors)
+
+    failed = len(errors)
+    _in_threads(delete, [(f"id{i}",) for i in range(10)])
+    assert len(errors) == failed
+
+
+def test_call_times_out_instead_of_hanging():
+    fake = FakeDrive()
+    storage = make_storage(fake, timeout=0.2)
+    release = threading.Event()
+
+    class StuckRequest:
+        def execute(self, http=None):
+            release.wait(5)
+            return {}
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        storage._batcher.call(StuckRequest())
+    assert time.monotonic() - started < 2
+    release.set()
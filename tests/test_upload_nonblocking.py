@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+from app import storage_factory
+from app.database import Base, SessionLocal, engine
+from app.models import User
+from app.security import create_access_token
+from app.storage_io import BlockingStorageMixin
+
+UPLOAD_SECONDS = 1.0
+CONCURRENT_UPLOADS = 6
+HEALTH_LATENCY_BOUND = 0.25
+
+
+class SlowAsyncStorage(BlockingStorageMixin):
+    # Like the Supabase REST backend: natively async I/O.
+
+    async def upload_file_async(self, filename, stream, content_type="application/octet-stream", user_id=None):
+        await asyncio.sleep(UPLOAD_SECONDS)
+        return f"async/{filename}"
+
+    def ping(self, timeout: float = 5) -> None:
+        pass
+
+
+class SlowBlockingStorage(BlockingStorageMixin):
+    # Like boto3/googleapiclient: blocking calls that must run off the event loop.
+
+    def upload_file(self, filename, stream, content_type="application/octet-stream", user_id=None):
+        time.sleep(UPLOAD_SECONDS)
+        return f"blocking/{filename}"
+
+    def ping(self, timeout: float = 5) -> None:
+        pass
+
+
+@pytest.fixture
+def auth_headers():
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        user = User(telegram_id=int(time.time() * 1000))
+        db.add(user)
+        db.commit()
+        return {"Authorization": f"Bearer {create_access_token(user.id)}"}
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def slow_storage(request):
+    previous = storage_factory._storage
+    storage_factory._storage = request.param()
+    yield storage_factory._storage
+    storage_factory._storage = previous
+
+
+async def _uploads_with_health_probes(headers: dict) -> tuple[list[int], list[float]]:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+        uploads = [
+            asyncio.create_task(
+                client.post(
+                    "/me/library/tracks/upload",
+                    files={"file": (f"track{i}.mp3", b"x" * 64 * 1024)},
+                    headers=headers,
+                )
+            )
+            for i in range(CONCURRENT_UPLOADS)
+        ]
+        await asyncio.sleep(0.1)
+        latencies = []
+        while not all(upload.done() for upload in uploads):
+            started = time.perf_counter()
+            response = await client.get("/health")
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200
+            await asyncio.sleep(0.05)
+        responses = await asyncio.gather(*uploads)
+    return [response.status_code for response in responses], latencies
+
+
+@pytest.mark.parametrize("slow_storage", [SlowAsyncStorage, SlowBlockingStorage], indirect=True)
+def test_health_stays_responsive_during_uploads(slow_storage, auth_headers):
+    started = time.perf_counter()
+    statuses, latencies = asyncio.run(_uploads_with_health_probes(auth_headers))
+    elapsed = time.perf_counter() - started
+
+    assert statuses == [200] * CONCURRENT_UPLOADS
+    # Probes ran while the uploads were still in flight, and none of them waited on storage.
+    assert len(latencies) >= 5
+    assert max(latencies) < HEALTH_LATENCY_BOUND
+    # The uploads overlapped instead of running one after another.
+    assert elapsed < UPLOAD_SECONDS * CONCURRENT_UPLOADS / 2